@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+'''
+Offline benchmark for quotamonitor.
+
+Starts local stand-ins for the storage APIs the collectors call (Vast, Qumulo,
+Nexenta, Racktop and Starfish), an SMTP sink and a sqlite stand-in for the
+database, fills them with a synthetic quota set of each requested size and
+times a full one-shot run against them. Each run is made in a child process
+so that its peak memory is its own. Nothing outside 127.0.0.1 is contacted.
+
+    ./benchmark.py --sizes 100,10000,1000000 --latency 5
+'''
+
+import os
+import sys
+import json
+import argparse
+import shutil
+import socketserver
+import sqlite3
+import ssl
+import subprocess
+import tempfile
+import threading
+import types
+import zlib
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit, urlunsplit
+
+import quotamonitor
+
+TERABYTE = quotamonitor.TERABYTE
+TEMPLATEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Storage path and nfs root of the synthetic quotas on each system
+LAYOUT = {
+    'vast':('/labs/{}', '/labs', '/nfs/vast'),
+    'qumulo':('/labs/{}/', '/labs', '/nfs/qumulo'),
+    'nexenta':('/pool/{}', '/pool', '/nfs/nexenta'),
+    'racktop':('/tank/{}', '/tank', '/nfs/racktop'),
+    }
+
+### Synthetic Data ###
+
+def figures(system, lab):
+    '''Usage, quota and file count for a lab, the same every time they are asked for.
+    About 3% of quotas are over 98% full, so the alert stage has work to do.'''
+    seed = zlib.crc32('{}/{}'.format(system, lab).encode())
+    quota = (1 + seed % 100) * TERABYTE
+    if seed % 100 < 3:
+        fill = 0.98 + (seed >> 8) % 300 / 10000.0
+    else:
+        fill = (seed >> 8) % 950 / 1000.0
+    return int(quota * fill), quota, (seed >> 4) % 5000000
+
+class synthetic_site:
+    '''A synthetic quota set of size entries, split evenly across systems. Every
+    system holds labs lab0000000 upwards, so the same lab appears on each of
+    them as it would at a real site. Each entry is serialized once, up front,
+    so that serving a listing costs about as much as it would on the array.'''
+    def __init__(self, size, systems, softquotas):
+        self.size = size
+        self.systems = systems
+        self.softquotas = softquotas
+        self.counts = {}
+        for i, system in enumerate(systems):
+            self.counts[system] = size // len(systems) + (1 if i < size % len(systems) else 0)
+        self.fragments = {}
+        for system, count in self.counts.items():
+            self.fragments[system] = [json.dumps(self.entry(system, self.lab(i))) for i in range(count)]
+
+    @staticmethod
+    def lab(i):
+        return 'lab{:07d}'.format(i)
+
+    def labs(self, system):
+        return (self.lab(i) for i in range(self.counts[system]))
+
+    def groups(self):
+        '''One lab in ten, capped at 10000, has its own settings. As many groups
+        again as one in ten of those have a Starfish soft quota on each system.'''
+        count = min(10000, max(1, max(self.counts.values()) // 10))
+        groups = {}
+        for i in range(count):
+            groups[self.lab(i)] = {'mail_to':['{}@bench.example.com'.format(self.lab(i))], 'warn_percent':95}
+        for group in self.softgroups():
+            groups[group] = {'mail_to':['{}@bench.example.com'.format(group)], 'warn_percent':95,
+                             'soft_quota':{system:'50' for system in self.systems}}
+        return groups
+
+    def softgroups(self):
+        if not self.softquotas:
+            return []
+        count = min(1000, max(1, max(self.counts.values()) // 100))
+        return ['shared{:06d}'.format(i) for i in range(count)]
+
+    def entry(self, system, lab):
+        usage, quota, files = figures(system, lab)
+        path = LAYOUT[system][0].format(lab)
+        if system == 'vast':
+            # Vast returns a good deal more than the collector reads, unless it asks for fields
+            return {'id':int(lab[3:]), 'guid':'{:032x}'.format(zlib.crc32(path.encode())), 'name':lab,
+                    'url':'https://vast.bench/api/quotas/{}'.format(int(lab[3:])), 'title':lab, 'state':'OK',
+                    'pretty_state':'OK', 'path':path, 'tenant_id':1, 'cluster':'bench', 'grace_period':'7 00:00:00',
+                    'soft_limit':quota, 'hard_limit':quota, 'soft_limit_inodes':None, 'hard_limit_inodes':None,
+                    'used_inodes':files, 'used_capacity':usage, 'used_capacity_tb':usage / float(TERABYTE),
+                    'used_effective_capacity':usage, 'used_effective_capacity_tb':usage / float(TERABYTE),
+                    'is_user_quota':False, 'enable_email_providers':False, 'sync_state':'SYNCHRONIZED'}
+        if system == 'qumulo':
+            return {'id':lab[3:], 'path':path, 'limit':str(quota), 'capacity_usage':str(usage)}
+        if system == 'nexenta':
+            return {'name':lab, 'path':path.lstrip('/'), 'bytesAvailable':quota - usage, 'bytesUsed':usage,
+                    'bytesReferenced':usage, 'referencedQuotaSize':quota}
+        if system == 'racktop':
+            return {'Path':path.lstrip('/'), 'Properties':[
+                {'Name':'used', 'Value':str(usage)}, {'Name':'available', 'Value':str(quota - usage)},
+                {'Name':'usedbydataset', 'Value':str(usage)}, {'Name':'refquota', 'Value':str(quota)}]}
+
+    def listing(self, system, start=0, end=None):
+        '''A json list of the entries of system from start to end'''
+        return '[' + ','.join(self.fragments[system][start:end]) + ']'
+
+    def freespace(self, system):
+        used = sum(figures(system, lab)[0] for lab in self.labs(system))
+        return used, used * 2
+
+### Stand-in Servers ###
+
+class api_handler(BaseHTTPRequestHandler):
+    '''Answers the requests each collector makes, from the server's site'''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, status=200):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.dispatch()
+
+    def do_GET(self):
+        self.dispatch()
+
+    def dispatch(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency:
+            sleep(self.server.latency)
+        parts = urlsplit(self.path)
+        query = {key:values[-1] for key, values in parse_qs(parts.query).items()}
+        try:
+            body = self.route(parts.path, query)
+        except Exception as excpt:
+            self.send_body({'error':str(excpt)}, 500)
+            return
+        if body is None:
+            self.send_body({'error':'not found: {}'.format(self.path)}, 404)
+        else:
+            self.send_body(body)
+
+    def route(self, path, query):
+        site = self.server.site
+        # Logins
+        if path in ('/api/auth/', '/auth/login', '/login'):
+            return {'token':'bench'}
+        if path == '/v1/session/login':
+            return {'bearer_token':'bench'}
+        # Vast
+        if path == '/api/clusters/':
+            used, total = site.freespace('vast')
+            return [{'logical_space':total, 'logical_space_in_use':used}]
+        if path == '/api/quotas/':
+            return self.vastquotas(site, query)
+        # Nexenta
+        if path == '/storage/filesystems':
+            # The pool itself comes first, with the space left in it
+            used, total = site.freespace('nexenta')
+            pool = json.dumps({'name':'pool', 'path':'pool', 'bytesAvailable':total - used, 'bytesUsed':used})
+            listing = site.listing('nexenta')[1:-1]
+            return '{"data":[' + ','.join(part for part in (pool, listing) if part) + ']}'
+        if path.startswith('/storage/filesystems/'):
+            name = unquote(path.rsplit('/', 1)[1]).split('/')[-1]
+            return {'name':name, 'referencedQuotaSize':figures('nexenta', name)[1]}
+        # Racktop
+        if path == '/internal/v1/zfs/datasets':
+            # The dataset asked for comes first, followed by those below it
+            used, total = site.freespace('racktop')
+            parent = json.dumps({'Path':query.get('dataset', ''), 'Properties':[
+                {'Name':'available', 'Value':str(total - used)}, {'Name':'used', 'Value':str(used)}]})
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', 0)) or None
+            fragments = [parent] + site.fragments['racktop'] if offset == 0 else site.fragments['racktop'][offset - 1:]
+            return '{"Datasets":[' + ','.join(fragments[:limit]) + ']}'
+        if path == '/internal/v1/zfs/dataset':
+            used, total = site.freespace('racktop')
+            return {'Dataset':{'Path':query.get('dataset'), 'Properties':[
+                {'Name':'available', 'Value':str(total - used)}, {'Name':'used', 'Value':str(used)}]}}
+        # Starfish
+        if path == '/api/scan/':
+            return [{'id':1, 'volume':query.get('volume'), 'state':'done'}]
+        if path.startswith('/api/query/'):
+            volume, _, subpath = unquote(path[len('/api/query/'):]).strip('/').partition(':')
+            if 'depth=1' in query.get('query', ''):
+                return [{'fn':lab, 'rec_aggrs':self.aggregates(volume, lab)} for lab in site.softgroups()]
+            return [{'rec_aggrs':self.aggregates(volume, subpath.strip('/'))}]
+        # Qumulo
+        if path == '/v1/file-system':
+            used, total = site.freespace('qumulo')
+            return {'free_size_bytes':str(total - used), 'total_size_bytes':str(total)}
+        if path == '/v1/files/quotas/status/':
+            limit = int(query.get('limit', 1000))
+            start = int(query.get('after', 0))
+            end = start + limit
+            after = '/v1/files/quotas/status/?after={}&limit={}'.format(end, limit) if end < site.counts['qumulo'] else ''
+            return '{"quotas":' + site.listing('qumulo', start, end) + ',"paging":' + json.dumps({'next':after}) + '}'
+        if path.startswith('/v1/files/') and path.endswith('/aggregates/'):
+            lab = unquote(path[len('/v1/files/'):-len('/aggregates/')]).strip('/').split('/')[-1]
+            return {'total_files':str(figures('qumulo', lab)[2])}
+        return None
+
+    @staticmethod
+    def vastquotas(site, query):
+        '''Vast quotas as a plain list, or a page of them if page_size is given,
+        with only the requested fields if fields is given'''
+        if 'page_size' in query:
+            pagesize = int(query['page_size'])
+            page = int(query.get('page', 1))
+            start = (page - 1) * pagesize
+            fragments = site.fragments['vast'][start:start + pagesize]
+        else:
+            fragments = site.fragments['vast']
+        if 'fields' in query:
+            fields = query['fields'].split(',')
+            fragments = [json.dumps({field:entry.get(field) for field in fields}) for entry in map(json.loads, fragments)]
+        results = '[' + ','.join(fragments) + ']'
+        if 'page_size' not in query:
+            return results
+        more = dict(query, page=page + 1)
+        following = 'https://vast.bench/api/quotas/?{}'.format(urlencode(more)) if start + pagesize < site.counts['vast'] else None
+        return '{"count":' + str(site.counts['vast']) + ',"next":' + json.dumps(following) + ',"results":' + results + '}'
+
+    @staticmethod
+    def aggregates(volume, lab):
+        usage, quota, files = figures('starfish-' + volume, lab)
+        return {'size':usage, 'files':files, 'dirs':files // 20}
+
+def startapi(site, latency, certificate=None):
+    '''Start a stand-in api server for site on a free port, with TLS if certificate
+    ((certfile, keyfile)) is given'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), api_handler)
+    server.daemon_threads = True
+    server.site = site
+    server.latency = latency
+    server.requests = 0
+    server.lock = threading.Lock()
+    if certificate is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*certificate)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def makecertificate(workdir):
+    '''Make a throwaway self signed certificate for the Qumulo stand-in, which
+    has to speak https, or return None if openssl is not available'''
+    openssl = shutil.which('openssl')
+    if openssl is None:
+        return None
+    certfile = os.path.join(workdir, 'bench.crt')
+    keyfile = os.path.join(workdir, 'bench.key')
+    result = subprocess.run(
+        [openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=127.0.0.1', '-keyout', keyfile, '-out', certfile],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    if result.returncode != 0:
+        return None
+    return certfile, keyfile
+
+class smtp_sink(socketserver.StreamRequestHandler):
+    '''Accepts and counts mail, enough of SMTP for smtplib'''
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.reply('220 bench ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line.rstrip(b'\r\n') == b'.':
+                        break
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+def startsmtp():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), smtp_sink)
+    server.daemon_threads = True
+    server.messages = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+### Database Stand-in ###
+
+def createdb(dbpath, site):
+    '''Make the sqlite file that stands in for the database, with a Maps row for
+    every lab and an empty table for each tier'''
+    dbcon = sqlite3.connect(dbpath)
+    dbcon.execute('CREATE TABLE Maps (Id INTEGER PRIMARY KEY, Name TEXT)')
+    count = max(site.counts.values())
+    dbcon.executemany('INSERT INTO Maps (Id, Name) VALUES (?, ?)', ((i, site.lab(i)) for i in range(count)))
+    for system in site.systems:
+        dbcon.execute('CREATE TABLE {} (Date TEXT, Path TEXT, Used INTEGER, Hard INTEGER, Map INTEGER)'.format(system))
+    dbcon.commit()
+    dbcon.close()
+
+class db_cursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor.execute(sql.replace('%s', '?'), params)
+
+    def executemany(self, sql, rows):
+        return self.cursor.executemany(sql.replace('%s', '?'), rows)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+class db_connection:
+    def __init__(self, dbpath):
+        self.dbcon = sqlite3.connect(dbpath, check_same_thread=False)
+
+    def cursor(self):
+        return db_cursor(self.dbcon.cursor())
+
+    def commit(self):
+        self.dbcon.commit()
+
+    def close(self):
+        self.dbcon.close()
+
+def installdb(dbpath):
+    '''Put a module shaped like the parts of pymysql that quotamonitor uses in
+    front of the real one, backed by the sqlite file at dbpath'''
+    sqlite3.register_adapter(date, str)
+    pymysql = types.ModuleType('pymysql')
+    pymysql.Error = sqlite3.Error
+    pymysql.connect = lambda **kwargs: db_connection(dbpath)
+    sys.modules['pymysql'] = pymysql
+
+def countrows(dbpath, systems):
+    dbcon = sqlite3.connect(dbpath)
+    rows = sum(dbcon.execute('SELECT COUNT(*) FROM {}'.format(system)).fetchone()[0] for system in systems)
+    dbcon.close()
+    return rows
+
+### Benchmark Run ###
+
+class bench_pool(quotamonitor.http_pool):
+    '''The shared http pool, with every request sent to the stand-in server instead'''
+    def __init__(self, address):
+        quotamonitor.http_pool.__init__(self)
+        self.address = address
+
+    def request(self, system, method, url, **kwargs):
+        parts = urlsplit(url)
+        local = urlunsplit(('http', self.address, parts.path, parts.query, ''))
+        return quotamonitor.http_pool.request(self, system, method, local, **kwargs)
+
+def buildconfig(site, workdir, api, qumulo, smtp):
+    storagesystems = {}
+    for system in site.systems:
+        pattern, prefix, nfsroot = LAYOUT[system]
+        entry = {
+            'type':system,
+            'url':'{}.bench'.format(system),
+            'user':'bench',
+            'password':'bench',
+            'logfile':os.path.join(workdir, '{}.csv'.format(system)),
+            'nfsmapping':{prefix:nfsroot},
+            }
+        if system == 'qumulo':
+            entry['url'], entry['port'] = qumulo.server_address
+            entry['file_count_cache'] = os.path.join(workdir, 'qumulo-files.json')
+        elif system == 'nexenta':
+            entry['toplevel'] = 'pool'
+        elif system == 'racktop':
+            entry['dataset'] = 'tank'
+        storagesystems[system] = entry
+    if site.softquotas:
+        storagesystems['starfish'] = {
+            'type':'starfish',
+            'url':'starfish.bench',
+            'user':'bench',
+            'password':'bench',
+            'logfile':'/dev/null',
+            'cache':os.path.join(workdir, 'starfish.json'),
+            'nfsmapping':{'/{}'.format(system):LAYOUT[system][2] for system in site.systems},
+            }
+    return {
+        'email_settings':{
+            'smtp_server':'{}:{}'.format(*smtp.server_address),
+            'sender_address':'quotamonitor@bench.example.com',
+            'default_recipient':['storageadmins@bench.example.com'],
+            'default_alert_percent':98,
+            'template_path':TEMPLATEPATH,
+            'state_path':os.path.join(workdir, 'alerts.db'),
+            'subject':{'warn':'{} {} Quota Near Limit', 'full':'{} {} Quota Full'},
+            },
+        'db_settings':{'user':'bench', 'password':'bench', 'host':'127.0.0.1', 'database':'quotas',
+                       'map':{system:system for system in site.systems}},
+        'policy_cache':os.path.join(workdir, 'policy.json'),
+        'snapshot_path':os.path.join(workdir, 'snapshot.json.gz'),
+        'history_path':os.path.join(workdir, 'history'),
+        'forecast_settings':{},
+        'metrics_settings':{'textfile':os.path.join(workdir, 'quotamonitor.prom')},
+        'application_shares':{},
+        'storagesystems':storagesystems,
+        'groups':site.groups(),
+        }
+
+def runchild(workdir):
+    '''Make one one-shot run in this process, as set up by the parent, and leave a run report behind'''
+    with open(os.path.join(workdir, 'child.json')) as j:
+        settings = json.load(j)
+    quotamonitor.logging.basicConfig(
+        filename=os.path.join(workdir, 'quotamonitor.log'),
+        format='%(asctime)s %(levelname)s: %(message)s',
+        level=getattr(quotamonitor.logging, settings['loglevel'].upper())
+        )
+    installdb(settings['db'])
+    configdict, groupdict, policy = quotamonitor.getconfig(settings['config'])
+    custom_mapping = policy.custom_mapping
+    quotamonitor.configdict = configdict
+    quotamonitor.alertpolicy = policy
+    quotamonitor.httppool = bench_pool(settings['address'])
+    quotamonitor.httppool.configure(configdict.get('http_settings', {}))
+    quotamonitor.pathindex = quotamonitor.path_index(configdict, groupdict, custom_mapping)
+    quotamonitor.runreport.instrument_paths(quotamonitor.pathindex)
+    quotamonitor.runonce(argparse.Namespace(full=settings['full']), groupdict, custom_mapping)
+    quotamonitor.runreport.write(os.path.join(workdir, 'report.json'))
+
+def runsize(size, systems, args, certificate):
+    '''Benchmark one size: serve a site of that size and make args.runs runs against it'''
+    workdir = tempfile.mkdtemp(prefix='quotabench-{}-'.format(size))
+    site = synthetic_site(size, systems, not args.no_starfish)
+    api = startapi(site, args.latency / 1000.0)
+    qumulo = startapi(site, args.latency / 1000.0, certificate) if 'qumulo' in systems else None
+    smtp = startsmtp()
+    dbpath = os.path.join(workdir, 'quotas.sqlite')
+    createdb(dbpath, site)
+    configpath = os.path.join(workdir, 'config.json')
+    with open(configpath, 'w') as j:
+        json.dump(buildconfig(site, workdir, api, qumulo, smtp), j)
+
+    results = []
+    for run in range(args.runs):
+        with open(os.path.join(workdir, 'child.json'), 'w') as j:
+            json.dump({
+                'config':configpath,
+                'db':dbpath,
+                'address':'{}:{}'.format(*api.server_address),
+                'full':args.full,
+                'loglevel':args.loglevel,
+                }, j)
+        requests = api.requests + (qumulo.requests if qumulo is not None else 0)
+        messages = smtp.messages
+        rows = countrows(dbpath, systems)
+        start = time()
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', workdir])
+        seconds = time() - start
+        if child.returncode != 0:
+            print('Run {} of size {} failed, see {}'.format(run + 1, size, os.path.join(workdir, 'quotamonitor.log')))
+            results.append(None)
+            continue
+        with open(os.path.join(workdir, 'report.json')) as j:
+            report = json.load(j)
+        quotas = sum(system['quotas'] for system in report['systems'].values())
+        results.append({
+            'size':size,
+            'run':run + 1,
+            'seconds':seconds,
+            'quotas':quotas,
+            'quotas_per_second':quotas / seconds,
+            'peak_memory_mb':report['peak_memory_mb'],
+            'requests':api.requests + (qumulo.requests if qumulo is not None else 0) - requests,
+            'messages':smtp.messages - messages,
+            'db_rows':countrows(dbpath, systems) - rows,
+            'report':report,
+            })
+    api.shutdown()
+    if qumulo is not None:
+        qumulo.shutdown()
+    smtp.shutdown()
+    if args.keep:
+        print('Kept {}'.format(workdir))
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def printresult(result):
+    print('{size:>9} {run:>4} {quotas:>9} {seconds:>8.2f} {quotas_per_second:>10.0f} {peak_memory_mb:>8.1f} '
+          '{requests:>8} {messages:>6} {db_rows:>8}'.format(**result))
+    phases = ', '.join('{} {:.2f}s'.format(phase['phase'], phase['seconds']) for phase in result['report']['phases'])
+    print('{:>15} {}'.format('', phases))
+    for name, system in sorted(result['report']['systems'].items()):
+        print('{:>15} {} {} {} quotas in {:.2f}s, {} requests'.format(
+            '', name, system['status'], system['quotas'], system['seconds'],
+            system['requests'] if system['requests'] is not None else 'uncounted'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark quotamonitor against local stand-ins for the storage, mail and db servers')
+    parser.add_argument('--sizes', type=str, default='100,1000,10000,100000', help='Comma separated quota counts to benchmark, split across the systems, default 100,1000,10000,100000')
+    parser.add_argument('--systems', type=str, default=','.join(LAYOUT), help='Comma separated systems to imitate, default {}'.format(','.join(LAYOUT)))
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds every api request is held for, default 0')
+    parser.add_argument('--runs', type=int, default=1, help='Runs per size against the same state, to see warm caches and incremental runs, default 1')
+    parser.add_argument('--full', action='store_true', help='Pass --full to each run')
+    parser.add_argument('--no-starfish', action='store_true', help='Leave out Starfish soft quotas')
+    parser.add_argument('--json', type=str, default=None, help='Also write every result, with its full run report, to this path')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory of each size')
+    parser.add_argument('--loglevel', type=str, default='warn', help='Level of logging in the runs, default warn')
+    parser.add_argument('--child', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        runchild(args.child)
+        sys.exit(0)
+
+    systems = [system for system in args.systems.split(',') if system]
+    unknown = [system for system in systems if system not in LAYOUT]
+    if unknown:
+        parser.error('unknown systems: {}'.format(', '.join(unknown)))
+    certificate = None
+    if 'qumulo' in systems:
+        certdir = tempfile.mkdtemp(prefix='quotabench-cert-')
+        try:
+            quotamonitor.importlib.import_module('qumulo.rest_client')
+            certificate = makecertificate(certdir)
+            if certificate is None:
+                print('Leaving out qumulo: openssl is needed for its https stand-in')
+        except ImportError:
+            print('Leaving out qumulo: the qumulo api module is not installed')
+        if certificate is None:
+            systems.remove('qumulo')
+    if not systems:
+        parser.error('no systems left to benchmark')
+
+    print('{:>9} {:>4} {:>9} {:>8} {:>10} {:>8} {:>8} {:>6} {:>8}'.format(
+        'size', 'run', 'quotas', 'seconds', 'quotas/s', 'peak MB', 'requests', 'mails', 'db rows'))
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        for result in runsize(size, systems, args, certificate):
+            results.append(result)
+            if result is not None:
+                printresult(result)
+    if certificate is not None:
+        shutil.rmtree(os.path.dirname(certificate[0]), ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as j:
+            json.dump(results, j, indent=2)
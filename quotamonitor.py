@@ -6,21 +6,35 @@ import smtplib
 import argparse
 from email.mime.text import MIMEText
 import collections
+import contextlib
+import copy
+import cProfile
+import pstats
+import sched
 import csv
-import requests
-import urllib3
-import isi_sdk_9_0_0 as isi_sdk
-from qumulo.rest_client import RestClient as qRestClient
-import six.moves.urllib as urllib
-from urllib.parse import quote
+import fcntl
+import gzip
+import importlib
+import inspect
+import zlib
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+import resource
+from urllib.parse import quote, urlencode, urlsplit
 from datetime import timedelta
 from datetime import datetime
-from time import time
+from datetime import timezone
+from time import time, sleep
 from string import Template
-import pymysql as mdb
 import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-urllib3.disable_warnings()
+# Vendor modules (requests, the Isilon SDK, the Qumulo client and pymysql) are
+# imported only once a configured system or stage needs them; see BACKENDS.
+STARTTIME = time()
 
 # Size Definitions
 KILOBYTE = 1024
@@ -28,10 +42,242 @@ MEGABYTE = 1024 * KILOBYTE
 GIGABYTE = 1024 * MEGABYTE
 TERABYTE = 1024 * GIGABYTE
 
+### HTTP Transport ###
+
+class http_pool:
+    '''Keep-alive sessions shared by the REST backends, with per-system request metrics'''
+    def __init__(self):
+        self.settings = {}
+        self.sessions = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def configure(self, settings):
+        self.settings = settings
+
+    def get_session(self, host):
+        import requests
+        import urllib3
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        urllib3.disable_warnings()
+        with self.lock:
+            if host not in self.sessions:
+                retries = Retry(
+                    total=self.settings.get('retries', 3),
+                    backoff_factor=self.settings.get('backoff', 0.5),
+                    status_forcelist=(500, 502, 503, 504)
+                    )
+                poolsize = self.settings.get('pool_size', 16)
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_maxsize=poolsize, max_retries=retries))
+                session.mount('http://', HTTPAdapter(pool_maxsize=poolsize, max_retries=retries))
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def request(self, system, method, url, **kwargs):
+        '''Send a request on the pooled session for the url's host, counting it against system'''
+        kwargs.setdefault('timeout', self.settings.get('timeout', 60))
+        kwargs.setdefault('verify', False)
+        session = self.get_session(urlsplit(url).netloc)
+        start = time()
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+            return response
+        finally:
+            with self.lock:
+                stats = self.stats.setdefault(system, {'requests':0, 'errors':0, 'seconds':0.0, 'bytes':0})
+                stats['requests'] += 1
+                stats['seconds'] += time() - start
+                if response is None or response.status_code >= 400:
+                    stats['errors'] += 1
+                if response is not None:
+                    stats['bytes'] += len(response.content)
+
+    def get(self, system, url, **kwargs):
+        return self.request(system, 'GET', url, **kwargs)
+
+    def post(self, system, url, **kwargs):
+        return self.request(system, 'POST', url, **kwargs)
+
+httppool = http_pool()
+
+### Run Report ###
+
+class run_report:
+    '''Times the stages and backend methods of a run, and writes them out as a json report'''
+    METHODS = ('login', 'get_free_space', 'get_free', 'get_mounts', 'get_all_quotas',
+               'get_file_counts', 'get_refquotas', 'get_scan_ids', 'process_quotas')
+
+    def __init__(self):
+        self.startup = None
+        self.phases = []
+        self.methods = {}
+        self.profiling = False
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Time a stage of the run; the caller may set 'items' on the yielded dict'''
+        entry = {'phase':name, 'seconds':0.0, 'items':None}
+        start = time()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = time() - start
+            self.phases.append(entry)
+            logging.info("{} took {:.2f}s".format(name, entry['seconds']))
+
+    def record(self, system, method, seconds, before=None, after=None):
+        with self.lock:
+            entry = self.methods.setdefault(system, {}).setdefault(method, {'calls':0, 'seconds':0.0, 'requests':None, 'bytes':None})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            if after is not None:
+                entry['requests'] = (entry['requests'] or 0) + after['requests'] - before['requests']
+                entry['bytes'] = (entry['bytes'] or 0) + after['bytes'] - before['bytes']
+
+    def timed(self, system, method, func):
+        if inspect.isgeneratorfunction(func):
+            return self.timedgenerator(system, method, func)
+        def wrapper(*args, **kwargs):
+            before = dict(httppool.stats.get(system, {'requests':0, 'bytes':0}))
+            start = time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(system, method, time() - start, before, httppool.stats.get(system))
+        return wrapper
+
+    def timedgenerator(self, system, method, func):
+        '''Like timed, for methods that stream their results. Only the time spent
+        inside the generator counts, not the caller's work between items.'''
+        def wrapper(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            before = dict(httppool.stats.get(system, {'requests':0, 'bytes':0}))
+            seconds = 0.0
+            try:
+                while True:
+                    start = time()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        seconds += time() - start
+                    yield item
+            finally:
+                self.record(system, method, seconds, before, httppool.stats.get(system))
+        return wrapper
+
+    def instrument(self, backend):
+        '''Time each of the backend's collection methods against its system'''
+        for method in self.METHODS:
+            if hasattr(backend, method):
+                setattr(backend, method, self.timed(backend.systemname, method, getattr(backend, method)))
+
+    def instrument_paths(self, index):
+        '''Time path translation per system'''
+        resolve = index.resolve
+        def timedresolve(toppath, systemname, mapsource=None):
+            start = time()
+            try:
+                return resolve(toppath, systemname, mapsource)
+            finally:
+                self.record(systemname, 'translate_path', time() - start)
+        index.resolve = timedresolve
+
+    def call(self, func):
+        if not self.profiling:
+            return func()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 and later allow one profiler at a time, and the main one already sees every thread
+            return func()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def systems(self):
+        systems = {}
+        for system, result in collectionstats.items():
+            obj = systemdict.get(system)
+            # A system that made no requests through httppool has none counted
+            requeststats = httppool.stats.get(system, {})
+            systems[system] = {
+                'status':result['status'],
+                'seconds':result['seconds'],
+                'error':None if result['error'] is None else str(result['error']),
+                'quotas':len(obj.quotadict) if obj is not None else 0,
+                'requests':requeststats.get('requests'),
+                'request_errors':requeststats.get('errors'),
+                'request_seconds':requeststats.get('seconds'),
+                'bytes':requeststats.get('bytes'),
+                'methods':self.methods.get(system, {}),
+                }
+        return systems
+
+    def write(self, reportpath):
+        report = {
+            'started':datetime.fromtimestamp(STARTTIME).isoformat(),
+            'seconds':time() - STARTTIME,
+            'startup_seconds':self.startup,
+            'peak_memory_mb':peak_memory(),
+            'phases':self.phases,
+            'systems':self.systems(),
+            }
+        try:
+            with open(reportpath, 'w') as f:
+                json.dump(report, f, indent=2)
+        except OSError as excpt:
+            logging.warn("Could not write run report {}: {}".format(reportpath, excpt))
+
+    def write_profile(self, profilepath, mainprofile):
+        stats = pstats.Stats(mainprofile)
+        for profile in self.profiles:
+            stats.add(profile)
+        stats.dump_stats(profilepath)
+        logging.info("Profile written to {}".format(profilepath))
+
+runreport = run_report()
+
+### Quota Records ###
+
+class quota_record:
+    '''One quota from a storage system; key is the lab, or lab--application on an application share'''
+    __slots__ = ('lab', 'application', 'usage', 'quota', 'files', 'nfspath', 'key')
+
+    def __init__(self, lab, application, usage, quota, files, nfspath, key=None):
+        self.lab = lab
+        self.application = application
+        self.usage = usage
+        self.quota = quota
+        self.files = files
+        self.nfspath = nfspath
+        if key is None:
+            key = '{}--{}'.format(lab, application) if application != '' else lab
+        self.key = key
+
+    def row(self):
+        '''The quota as a csv row'''
+        return [self.lab, self.usage, self.quota, self.files, self.application]
+
+# Free and total bytes of a storage system, kept next to its quotadict
+free_space = collections.namedtuple('free_space', ('freesize', 'totalsize'))
+
 ### Storage Class Definitions ###
 
 # Qumulo
 class q_api:
+    requires = ('qumulo.rest_client',)
+
     def __init__(self, name, qconfig):
         self.systemname = name
         self.user = qconfig['user']
@@ -40,12 +286,19 @@ class q_api:
         self.port = qconfig['port']
         self.logfile = qconfig['logfile']
         self.nfsmapping = qconfig['nfsmapping']
+        self.filecounts = qconfig.get('file_counts', False)
+        self.filecountworkers = qconfig.get('file_count_workers', 8)
+        self.filecountcache = qconfig.get('file_count_cache', '/var/tmp/quotamonitor-{}-files.json'.format(name))
+        self.pagesize = qconfig.get('page_size', 1000)
+        self.loggedin = False
         
     def login(self):
         '''Obtain credentials from the REST server'''
         try:
+            qRestClient = importlib.import_module('qumulo.rest_client').RestClient
             self.rc = qRestClient(self.host, self.port)
             self.rc.login(self.user, self.password)
+            self.loggedin = True
         except Exception as excpt:
             logging.warn(("Error connecting to the REST server: {}".format(excpt)))
             #print(__doc__)
@@ -57,9 +310,12 @@ class q_api:
         self.totalsize = int(fs_stats['total_size_bytes'])
 
     def get_all_quotas(self):
+        '''Yield every quota on the cluster. Pages of page_size quotas are fetched
+        as they are needed, so only one is held in memory at a time.'''
         try:
-            all_quotas_raw = self.rc.quota.get_all_quotas_with_status(10000)
-            self.quotalist = list(all_quotas_raw)[0]['quotas']
+            for page in self.rc.quota.get_all_quotas_with_status(self.pagesize):
+                for quota in page['quotas']:
+                    yield quota
         except Exception as excpt:
             logging.error(("An error occurred contacting the storage for the quota list: {}".format(excpt)))
             sys.exit(1)
@@ -69,30 +325,57 @@ class q_api:
         fs_stats = self.rc.fs.read_dir_aggregates(toppath)
         total_files = int(fs_stats['total_files'])
         return total_files
+
+    def get_file_counts(self, usagebypath):
+        '''Look up total_files for every path in usagebypath ({path: capacity_usage}).
+        Counts from the previous run are reused for directories whose usage has not
+        changed; the rest are fetched on a bounded pool of threads.'''
+        cache = load_json_cache(self.filecountcache)
+        counts = {}
+        tofetch = []
+        for path, usage in usagebypath.items():
+            cached = cache.get(path)
+            if cached is not None and cached['capacity_usage'] == usage:
+                counts[path] = cached['total_files']
+            else:
+                tofetch.append(path)
+        logging.info("{}: reusing {} file counts, fetching {}".format(self.systemname, len(counts), len(tofetch)))
+        with ThreadPoolExecutor(max_workers=self.filecountworkers) as pool:
+            futures = {pool.submit(self.get_total_files, path):path for path in tofetch}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    counts[path] = future.result()
+                except Exception as excpt:
+                    logging.warn("Could not get file count for {} on {}: {}".format(path, self.systemname, excpt))
+        save_json_cache(self.filecountcache, {
+            path:{'capacity_usage':usagebypath[path], 'total_files':count} for path, count in counts.items()
+            })
+        return counts
     
     def process_quotas(self, custom_mapping, groupdict):
-        self.login()
+        if not self.loggedin:
+            self.login()
         self.get_free_space()
-        self.get_all_quotas()
         self.quotadict = {}
-        for quota in self.quotalist:
-            lab, nfspath, application = translate_path(quota['path'], self.systemname, self.nfsmapping, custom_mapping, groupdict)
+        labpaths = {}
+        for quota in self.get_all_quotas():
+            lab, nfspath, application = translate_path(quota['path'], self.systemname)
             if nfspath:
-                if application != '':
-                    lab = '{}--{}'.format(lab, application)
-                self.quotadict[lab]={
-                    'usage':int(quota['capacity_usage']),
-                    'quota':int(quota['limit']),
-                    'total_files':self.get_total_files(quota['path']),
-                    'total_files':0,
-                    'nfspath':nfspath,
-                    'special':application
-                    }
-        self.quotadict['FREE'] = {'freesize':self.freesize,'totalsize':self.totalsize}
+                record = quota_record(lab, application, int(quota['capacity_usage']), int(quota['limit']), 0, nfspath)
+                self.quotadict[record.key] = record
+                labpaths[record.key] = quota['path']
+        if self.filecounts:
+            counts = self.get_file_counts({path:self.quotadict[key].usage for key, path in labpaths.items()})
+            for key, path in labpaths.items():
+                self.quotadict[key].files = counts.get(path, 0)
+        self.freespace = free_space(self.freesize, self.totalsize)
 
             
 # Vast		
 class v_api:
+    requires = ('requests',)
+
     def __init__(self, name, vconfig):
         self.systemname = name
         self.user = vconfig['user']
@@ -100,11 +383,11 @@ class v_api:
         self.host = vconfig['url']
         self.logfile = vconfig['logfile']
         self.nfsmapping = vconfig['nfsmapping']
+        self.pagesize = vconfig.get('page_size', 1000)
         
     def get_data(self, vobj):
         try:
-            s = requests.session()
-            data = s.get('https://{}/api/{}/'.format(self.host, vobj), auth=(self.user, self.password), verify=False)
+            data = httppool.get(self.systemname, 'https://{}/api/{}/'.format(self.host, vobj), auth=(self.user, self.password))
             datajson = data.json()
             if 'detail' in list(datajson[0].keys()):
                 logging.error(('{} failed login: '.format(self.systemname)))
@@ -119,33 +402,52 @@ class v_api:
     def get_free_space(self):
         clusterdata = self.get_data('clusters')
         inuse = int(clusterdata[0]["logical_space_in_use"])
-        self.totalsize = int(self.get_data('clusters')[0]["logical_space"])
+        self.totalsize = int(clusterdata[0]["logical_space"])
         self.freesize = self.totalsize - inuse
 
+    def get_pages(self, vobj, params):
+        '''Yield the items of a paged listing, following "next" until it runs out. A
+        cluster that does not page answers with a plain list, which is taken as
+        the only page.'''
+        urltoget = 'https://{}/api/{}/?{}'.format(self.host, vobj, urlencode(params))
+        try:
+            while urltoget:
+                data = httppool.get(self.systemname, urltoget, auth=(self.user, self.password)).json()
+                if isinstance(data, list):
+                    yield from data
+                    return
+                if 'detail' in data:
+                    logging.error(('{} failed login: '.format(self.systemname)))
+                    logging.error((data['detail']))
+                    sys.exit(1)
+                yield from data['results']
+                urltoget = data.get('next')
+        except Exception as excpt:
+            logging.error(("Error connecting to the REST server: {}".format(excpt)))
+            sys.exit(1)
+
     def get_all_quotas(self):
-        self.quotalist = self.get_data('quotas')
+        '''Yield every quota, with only the fields process_quotas uses, a page at a time'''
+        yield from self.get_pages('quotas', {
+            'page_size':self.pagesize,
+            'fields':'path,used_capacity,hard_limit,used_inodes'
+            })
     
     def process_quotas(self, custom_mapping, groupdict):
         self.get_free_space()
-        self.get_all_quotas()
         self.quotadict = {}
-        for quota in self.quotalist:
-            lab, nfspath, application = translate_path(quota['path'], self.systemname, self.nfsmapping, custom_mapping, groupdict)
+        for quota in self.get_all_quotas():
+            lab, nfspath, application = translate_path(quota['path'], self.systemname)
             if nfspath is None:
                 continue
-            if application != '':
-                lab = '{}--{}'.format(lab, application)
-            self.quotadict[lab]={
-                'usage':int(quota['used_capacity']),
-                'quota':int(quota['hard_limit']),
-                'total_files':int(quota['used_inodes']),
-                'nfspath':nfspath,
-                'special':application
-                }
-        self.quotadict['FREE'] = {'freesize':self.freesize,'totalsize':self.totalsize}
+            record = quota_record(lab, application, int(quota['used_capacity']), int(quota['hard_limit']), int(quota['used_inodes']), nfspath)
+            self.quotadict[record.key] = record
+        self.freespace = free_space(self.freesize, self.totalsize)
 
 # Isilon
 class i_api:
+    requires = ('isi_sdk_9_0_0',)
+
     def __init__(self, name, iconfig):
         self.systemname = name
         self.user = iconfig['user']
@@ -153,9 +455,12 @@ class i_api:
         self.host = iconfig['url']
         self.logfile = iconfig['logfile']
         self.nfsmapping = iconfig['nfsmapping']
+        self.pagesize = iconfig.get('page_size', 1000)
         self.quotadict = {}
+        self.loggedin = False
         
     def login(self):
+        isi_sdk = importlib.import_module('isi_sdk_9_0_0')
         # configure cluster connection: basicAuth
         configuration = isi_sdk.Configuration()
         configuration.host = 'https://{}:8080'.format(self.host)
@@ -166,6 +471,7 @@ class i_api:
         api_client = isi_sdk.ApiClient(configuration)
         self.cluster_api = isi_sdk.ClusterApi(api_client)
         self.quota_api = isi_sdk.QuotaApi(api_client)
+        self.loggedin = True
         
     def get_free_space(self):
         clusterinfo = self.cluster_api.get_cluster_statfs()
@@ -173,30 +479,38 @@ class i_api:
         self.freesize = clusterinfo.f_bavail * clusterinfo.f_bsize
     
     def get_all_quotas(self):
-        self.quotalist = self.quota_api.list_quota_quotas().to_dict()['quotas']
+        '''Yield every directory quota as the SDK's model objects, page_size at a
+        time. Later pages are asked for with the resume token alone, which
+        carries the rest of the query.'''
+        response = self.quota_api.list_quota_quotas(type='directory', limit=self.pagesize)
+        while True:
+            for quota in response.quotas or []:
+                yield quota
+            if not response.resume:
+                break
+            response = self.quota_api.list_quota_quotas(resume=response.resume)
 
     def process_quotas(self, custom_mapping, groupdict):
-        self.login()
+        if not self.loggedin:
+            self.login()
         self.get_free_space()
-        self.get_all_quotas()
-        for quota in self.quotalist:
-            toppath = quota['path']
-            lab, nfspath, application = translate_path(toppath, self.systemname, self.nfsmapping, custom_mapping, groupdict)
+        self.quotadict = {}
+        for quota in self.get_all_quotas():
+            if quota.thresholds.hard is None:
+                # Accounting only, there is no limit to report against
+                continue
+            toppath = quota.path
+            lab, nfspath, application = translate_path(toppath, self.systemname)
         #    print(lab, nfspath, application)
             if nfspath is not None:
-                if application != '':
-                    lab = '{}--{}'.format(lab, application)
-                self.quotadict[lab]={
-                    'usage':int(quota['usage']['fslogical']),
-                    'quota':int(quota['thresholds']['hard']),
-                    'total_files':int(quota['usage']['inodes']),
-                    'nfspath':nfspath,
-                    'special':application
-                    }
-        self.quotadict['FREE'] = {'freesize':self.freesize,'totalsize':self.totalsize}
+                record = quota_record(lab, application, int(quota.usage.fslogical), int(quota.thresholds.hard), int(quota.usage.inodes), nfspath)
+                self.quotadict[record.key] = record
+        self.freespace = free_space(self.freesize, self.totalsize)
 
 # Racktop
 class r_api:
+    requires = ('requests',)
+
     def __init__(self, name, rconfig):
         self.systemname = name
         self.user = rconfig['user']
@@ -205,73 +519,90 @@ class r_api:
         self.dataset = rconfig['dataset']
         self.logfile = rconfig['logfile']
         self.nfsmapping = rconfig['nfsmapping']
+        self.pagesize = rconfig.get('page_size', 1000)
+        self.loggedin = False
         
     def login(self):
         self.headers = {'Content-Type': 'application/json'}
-        response = requests.post(
+        response = httppool.post(
+            self.systemname,
             "https://{}:8443/login".format(self.host),
             headers=self.headers,
-            auth=(self.user, self.password), 
-            verify=False
+            auth=(self.user, self.password)
             )
         self.headers['Authorization'] = "Bearer {}".format(response.json()['token'])
+        self.loggedin = True
     
     def get_all_quotas(self):
-        self.quotalist = []
+        '''Yield every filesystem under the dataset, page_size at a time. The dataset
+        itself comes first in the listing; it is not a quota, but if it is the
+        pool its available and used space give the free space.'''
         self.headers['User-Agent'] = "BsrCli"
-        urltoget = "https://{}:8443/internal/v1/zfs/datasets?dataset={}&types=all&props=refquota,usedbydataset&offset=1".format(self.host, self.dataset)
-        response = requests.get(urltoget, headers=self.headers, verify=False)
-        if response.status_code != 200:
-            logging.warn("invalid auth response")
-            logging.warn((response.request))
-            logging.warn((response.reason))
-        datasets_raw = response.json()['Datasets']
-        for dataset in datasets_raw:
-            self.quotalist.append({
-                'toppath':'/' + dataset['Path'],
-                'refquota':dataset['Properties'][0]['Value'], 
-                'used':dataset['Properties'][1]['Value']
-                })
+        volume = self.dataset.split('/')[0]
+        offset = 0
+        while True:
+            urltoget = "https://{}:8443/internal/v1/zfs/datasets?dataset={}&types=filesystem&props=refquota,usedbydataset,available,used&offset={}&limit={}".format(
+                self.host, self.dataset, offset, self.pagesize)
+            response = httppool.get(self.systemname, urltoget, headers=self.headers)
+            if response.status_code != 200:
+                logging.warn("invalid auth response")
+                logging.warn((response.request))
+                logging.warn((response.reason))
+            datasets_raw = response.json()['Datasets']
+            for dataset in datasets_raw:
+                properties = {prop['Name']:prop['Value'] for prop in dataset['Properties']}
+                if dataset['Path'] == self.dataset:
+                    if self.dataset == volume:
+                        self.freesize = int(properties['available'])
+                        self.totalsize = self.freesize + int(properties['used'])
+                    continue
+                yield {
+                    'toppath':'/' + dataset['Path'],
+                    'refquota':properties['refquota'],
+                    'used':properties['usedbydataset']
+                    }
+            if len(datasets_raw) < self.pagesize:
+                break
+            offset += len(datasets_raw)
     
     def get_free(self):
         self.headers['User-Agent'] = "BsrCli"
         volume = self.dataset.split('/')[0]
         urltoget = "https://{}:8443/internal/v1/zfs/dataset?dataset={}".format(self.host, volume)
-        response = requests.get(urltoget, headers=self.headers, verify=False)
+        response = httppool.get(self.systemname, urltoget, headers=self.headers)
         try:
-            free_raw = response.json()['Dataset']
-        except:
-            print(self.host, volume)
-            print(response.json())
-            return
-        self.freesize = [property for property in free_raw['Properties'] if property['Name'] == 'available'][0]['Value']
-        used = [property for property in free_raw['Properties'] if property['Name'] == 'used'][0]['Value']
-        self.totalsize = int(self.freesize) + int(used)
-      
-                                    
+            properties = {prop['Name']:prop['Value'] for prop in response.json()['Dataset']['Properties']}
+            self.freesize = int(properties['available'])
+            self.totalsize = self.freesize + int(properties['used'])
+        except (ValueError, KeyError, TypeError) as excpt:
+            # ValueError also covers a body that is not json at all
+            self.freesize = None
+            logging.warn("Could not read free space of {} on {}: {}".format(volume, self.host, excpt))
+            logging.warn((response.reason))
+
     def process_quotas(self, custom_mapping, groupdict):
-        self.login()
-        self.get_all_quotas()
-        #self.get_free()
+        if not self.loggedin:
+            self.login()
+        self.freesize = None
+        self.freespace = None
         self.quotadict = {}
-        for quota in self.quotalist:
-            lab, nfspath, application = translate_path(quota['toppath'], self.systemname, self.nfsmapping, custom_mapping, groupdict)
+        for quota in self.get_all_quotas():
+            lab, nfspath, application = translate_path(quota['toppath'], self.systemname)
             if nfspath is None:
               continue
-            if application != '':
-                lab = '{}--{}'.format(lab, application)
-            self.quotadict[lab]={
-                'usage':int(quota['used']),
-                'quota':int(quota['refquota']),
-                'total_files':0,
-                'nfspath':nfspath,
-                'special':application
-                }
-        #self.quotadict['FREE'] = {'freesize':self.freesize,'totalsize':self.totalsize}
+            record = quota_record(lab, application, int(quota['used']), int(quota['refquota']), 0, nfspath)
+            self.quotadict[record.key] = record
+        if self.freesize is None:
+            # The dataset is below the pool, so ask for the pool itself
+            self.get_free()
+        if self.freesize is not None:
+            self.freespace = free_space(int(self.freesize), self.totalsize)
 
 #Nexenta 5
 
 class n_api:
+    requires = ('requests',)
+
     def __init__(self, name, nconfig):
         self.systemname = name
         self.user = nconfig['user']
@@ -280,26 +611,31 @@ class n_api:
         self.toplevel = nconfig['toplevel']
         self.logfile = nconfig['logfile']
         self.nfsmapping = nconfig['nfsmapping']
+        self.workers = nconfig.get('workers', 8)
+        self.loggedin = False
         
     def login(self):
         self.headers = {'Content-Type': 'application/json'}
         auth_params = {"username": self.user, "password": self.password}
-        response = requests.post(
+        response = httppool.post(
+            self.systemname,
             "https://{}:8443/auth/login".format(self.host),
             headers=self.headers,
-            data=json.dumps(auth_params),
-            verify=False
+            data=json.dumps(auth_params)
             )
         if response.status_code != 200:
             logging.warn("invalid auth response")
             logging.warn((response.request))
             logging.warn((response.reason))
         self.headers['Authorization'] = "Bearer {}".format(response.json()['token'])
+        self.loggedin = True
     
     def get_all_quotas(self):
         self.quotalist = []
-        urltoget = "https://{}:8443/storage/filesystems".format(self.host)
-        response = requests.get(urltoget, headers=self.headers, verify=False)
+        # Ask for referencedQuotaSize in the listing itself rather than once per filesystem
+        fields = 'name,path,bytesAvailable,bytesUsed,bytesReferenced,referencedQuotaSize'
+        urltoget = "https://{}:8443/storage/filesystems?fields={}".format(self.host, fields)
+        response = httppool.get(self.systemname, urltoget, headers=self.headers)
         if response.status_code != 200:
             logging.warn("invalid api response")
             logging.warn((response.request))
@@ -313,58 +649,78 @@ class n_api:
         self.freesize = topinfo['bytesAvailable']
         used = topinfo['bytesUsed']
         self.totalsize = self.freesize + used
+        missing = [dataset['name'] for dataset in datasets_raw if 'referencedQuotaSize' not in dataset]
+        refquotas = self.get_refquotas(missing) if missing else {}
         for dataset in datasets_raw:
             name = dataset['name']
+            refquota = dataset.get('referencedQuotaSize', refquotas.get(name))
+            if refquota is None:
+                continue
             self.quotalist.append({
                 'toppath':'/{}'.format(dataset['path']),
-                'refquota':self.get_refquota(name),
+                'refquota':refquota,
                 'used':dataset['bytesReferenced']
             })
 
     def get_refquota(self, name):
         urltoget = "https://{}:8443/storage/filesystems/{}%2F{}".format(self.host, self.toplevel, name)
-        response = requests.get(urltoget, headers=self.headers, verify=False)
+        response = httppool.get(self.systemname, urltoget, headers=self.headers)
         rawdata = response.json()
         refquota = rawdata['referencedQuotaSize']
         return refquota
+
+    def get_refquotas(self, names):
+        '''Fall back to per-filesystem lookups, a bounded number at a time, for
+        filesystems the listing did not return a referencedQuotaSize for'''
+        logging.info("{}: looking up refquota for {} filesystems individually".format(self.systemname, len(names)))
+        refquotas = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.get_refquota, name):name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    refquotas[name] = future.result()
+                except Exception as excpt:
+                    logging.warn("Could not get refquota for {} on {}: {}".format(name, self.systemname, excpt))
+        return refquotas
       
     def process_quotas(self, custom_mapping, groupdict):
-        self.login()
+        if not self.loggedin:
+            self.login()
         self.get_all_quotas()
         self.quotadict = {}
         for quota in self.quotalist:
-            lab, nfspath, application = translate_path(quota['toppath'], self.systemname, self.nfsmapping, custom_mapping, groupdict)
+            lab, nfspath, application = translate_path(quota['toppath'], self.systemname)
             if nfspath is None:
               continue
-            if application != '':
-                lab = '{}--{}'.format(lab, application)
-            self.quotadict[lab]={
-                'usage':int(quota['used']),
-                'quota':int(quota['refquota']),
-                'total_files':0,
-                'nfspath':nfspath,
-                'special':application
-                }
-        self.quotadict['FREE'] = {'freesize':self.freesize,'totalsize':self.totalsize}
+            record = quota_record(lab, application, int(quota['used']), int(quota['refquota']), 0, nfspath)
+            self.quotadict[record.key] = record
+        self.freespace = free_space(self.freesize, self.totalsize)
 
 # Starfish
 class sf_api:
+    requires = ('requests',)
+
     def __init__(self, sfconfig):
+        self.systemname = 'starfish'
         self.user = sfconfig['user']
         self.password = sfconfig['password']
         self.host = sfconfig['url']
         self.logfile = sfconfig['logfile']
         self.nfsmapping = sfconfig['nfsmapping']
+        self.workers = sfconfig.get('workers', 8)
+        self.cachepath = sfconfig.get('cache', '/var/tmp/quotamonitor-starfish.json')
         self.response = {}
+        self.loggedin = False
         
     def login(self):
         auth_params = {"username": self.user, "password": self.password}
         self.headers = {'Content-Type': 'application/json'}
-        response = requests.post(
+        response = httppool.post(
+            self.systemname,
             "https://{}/api/auth/".format(self.host), 
             data=json.dumps(auth_params), 
-            headers=self.headers, 
-            verify=False
+            headers=self.headers
             )
         if response.status_code != 200:
             logging.warn("invalid auth response")
@@ -373,23 +729,96 @@ class sf_api:
         else:
             token = response.json()['token']
             self.headers['Authorization'] = "Bearer {}".format(token)
+            self.loggedin = True
     
     def getquota(self, vol_path):
         volencoded = quote(vol_path, safe=':')
-        sf_response = requests.get(
+        sf_response = httppool.get(
+            self.systemname,
             "https://{}/api/query/{}/?query=depth=0&type=d&format=rec_aggrs&output_format=json".format(self.host, volencoded), 
-            headers=self.headers, 
-            verify=False
+            headers=self.headers
             ).json()
         if len(sf_response) == 1:
             return sf_response[0]
         else:
             logging.warn("Exception on vol_path, multiple items returned")
     
+    def getvolume(self, volume, names):
+        '''Fetch rec_aggrs for every top level directory of a volume in one query and
+        return those named in names, keyed by "volume:name"'''
+        volencoded = quote('{}:'.format(volume), safe=':')
+        sf_response = httppool.get(
+            self.systemname,
+            "https://{}/api/query/{}/?query=depth=1&type=d&format=fn+rec_aggrs&output_format=json".format(self.host, volencoded), 
+            headers=self.headers
+            ).json()
+        return {'{}:{}'.format(volume, entry['fn']):entry for entry in sf_response if entry.get('fn') in names}
+
+    def get_scan_ids(self, volumes):
+        '''Return the id of the latest finished scan of each volume, or None where it could not be found'''
+        scans = {}
+        for volume in volumes:
+            try:
+                sf_response = httppool.get(
+                    self.systemname,
+                    "https://{}/api/scan/?volume={}&state=done".format(self.host, quote(volume)),
+                    headers=self.headers
+                    ).json()
+                scans[volume] = max(scan['id'] for scan in sf_response)
+            except Exception as excpt:
+                logging.info("Could not find the last scan of {}: {}".format(volume, excpt))
+                scans[volume] = None
+        return scans
+
     def get_all_quotas(self, volpathlimits):
+        '''Look up rec_aggrs for each volume:path. Results cached from the last run are
+        reused for volumes that have not been scanned since; otherwise each volume
+        is fetched in one query, with single path queries on a bounded pool for
+        anything that query does not cover.'''
+        cache = load_json_cache(self.cachepath)
+        volumes = {}
+        for vol_path in volpathlimits:
+            volume, path = vol_path.split(':', 1)
+            volumes.setdefault(volume, []).append(path)
+        scans = self.get_scan_ids(volumes)
+
+        sfdata = {}
+        for vol_path in volpathlimits:
+            volume = vol_path.split(':', 1)[0]
+            cached = cache.get(vol_path)
+            if cached is not None and scans[volume] is not None and cached['scan'] == scans[volume]:
+                sfdata[vol_path] = cached['sfdata']
+        logging.info("Starfish: reusing {} of {} cached soft quotas".format(len(sfdata), len(volpathlimits)))
+
+        for volume, paths in volumes.items():
+            names = set(path for path in paths if '{}:{}'.format(volume, path) not in sfdata and '/' not in path.strip('/'))
+            if not names:
+                continue
+            try:
+                sfdata.update(self.getvolume(volume, names))
+            except Exception as excpt:
+                logging.warn("Could not query {} as a whole, falling back to single paths: {}".format(volume, excpt))
+
+        remaining = [vol_path for vol_path in volpathlimits if vol_path not in sfdata]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.getquota, vol_path):vol_path for vol_path in remaining}
+            for future in as_completed(futures):
+                vol_path = futures[future]
+                try:
+                    result = future.result()
+                except Exception as excpt:
+                    logging.warn("Could not get {} from Starfish: {}".format(vol_path, excpt))
+                    continue
+                if result is not None:
+                    sfdata[vol_path] = result
+
         self.sfquotadict = {}
-        for vol_path,limit in volpathlimits.items():
-            self.sfquotadict[vol_path] = {'sfdata':self.getquota(vol_path), 'limit':limit}
+        for vol_path, limit in volpathlimits.items():
+            if vol_path in sfdata:
+                self.sfquotadict[vol_path] = {'sfdata':sfdata[vol_path], 'limit':limit}
+        save_json_cache(self.cachepath, {
+            vol_path:{'scan':scans[vol_path.split(':', 1)[0]], 'sfdata':data} for vol_path, data in sfdata.items()
+            })
         
     def process_quotas(self, custom_mapping, groupdict):
         self.softquotadict = {}
@@ -398,58 +827,87 @@ class sf_api:
             if storage not in list(self.softquotadict.keys()):
                 self.softquotadict[storage] = {}
             rawpath = '/{}/{}'.format(storage,path)
-            lab, nfspath, application = translate_path(rawpath, storage, self.nfsmapping, custom_mapping, groupdict)
+            lab, nfspath, application = translate_path(rawpath, storage, 'starfish')
             if nfspath is None:
                 continue
-            if application != '':
-                lab = '{}--{}'.format(lab, application)
-            self.softquotadict[storage][lab]={
-                'usage':int(sfquota['sfdata']['rec_aggrs']['size']),
-                'total_files':int(sfquota['sfdata']['rec_aggrs']['files']) + int(sfquota['sfdata']['rec_aggrs']['dirs']),
-                'quota':int(sfquota['limit'] * TERABYTE),
-                'nfspath':nfspath,
-                'special':'soft'
-                }
+            rec_aggrs = sfquota['sfdata']['rec_aggrs']
+            record = quota_record(
+                lab, 'soft',
+                int(rec_aggrs['size']),
+                int(sfquota['limit'] * TERABYTE),
+                int(rec_aggrs['files']) + int(rec_aggrs['dirs']),
+                nfspath,
+                '{}--{}'.format(lab, application) if application != '' else lab
+                )
+            self.softquotadict[storage][record.key] = record
 
 # Mounted storage w/o API
 class df_system:
+    requires = ()
+
     def __init__(self, name, dfconfig):
         self.systemname = name
         self.mountpath = dfconfig['mountpath']
         self.logfile = dfconfig['logfile']
         self.nfsmapping = dfconfig['nfsmapping']
+        self.workers = dfconfig.get('workers', 16)
+        self.timeout = dfconfig.get('mount_timeout', 10)
+        self.stale = []
+        self.hung = set()
+        self.freespace = None
     
     def get_mounts(self):
-        f = open('/etc/mtab', 'r')
-        self.mounts = [line.split()[1] for line in f
-                      if line.split()[0].startswith(self.mountpath)]
-        f.close()
+        '''Read the mount table once, keeping the mount points of sources under mountpath'''
+        with open('/etc/mtab', 'r') as f:
+            self.mounts = [line.split()[1].replace('\\040', ' ') for line in f
+                          if line.split()[0].startswith(self.mountpath)]
         
     def get_all_quotas(self):
+        '''statvfs every mount, workers at a time, giving each mount_timeout seconds.
+        A mount that does not answer is reported as stale. Its probe may still
+        be stuck in the kernel, so it is not probed again until that returns.'''
         self.quotalist = []
+        self.stale = []
+        results = {}
+        tasks = {}
         for mount in self.mounts:
-            rawusage = os.popen("df {}".format(mount))
-            line = rawusage.readlines()[-1]
-            self.quotalist.append(line.split())
+            if mount in self.hung:
+                self.stale.append(mount)
+                continue
+            def probe(mount=mount):
+                self.hung.add(mount)
+                try:
+                    results[mount] = os.statvfs(mount)
+                finally:
+                    self.hung.discard(mount)
+            tasks[mount] = (probe, self.timeout)
+        for mount, result in run_with_deadlines(tasks, self.workers).items():
+            if result['status'] == 'ok':
+                self.quotalist.append((mount, results[mount]))
+            elif result['status'] == 'timeout':
+                self.stale.append(mount)
+            else:
+                logging.warn("{}: could not stat {}: {}".format(self.systemname, mount, result['error']))
+        if self.stale:
+            logging.warn("{}: stale mounts, left out: {}".format(self.systemname, ', '.join(sorted(self.stale))))
             
     def process_quotas(self, custom_mapping, groupdict):
         self.get_mounts()
         self.get_all_quotas()
         self.quotadict = {}
-        for quota in self.quotalist:
-            toppath = quota[5]
-            lab, nfspath, application = translate_path(toppath, self.systemname, self.nfsmapping, custom_mapping, groupdict)
+        for toppath, stats in self.quotalist:
+            lab, nfspath, application = translate_path(toppath, self.systemname)
             if nfspath is None:
                 continue
-            if application != '':
-                lab = '{}--{}'.format(lab, application)
-            self.quotadict[lab]={
-                'usage':int(quota[2]) * KILOBYTE,
-                'quota':int(quota[1]) * KILOBYTE,
-                'total_files':0,
-                'nfspath':nfspath,
-                'special':application
-                }
+            # As df reports them: used is everything that is not free, including root's reserve
+            record = quota_record(
+                lab, application,
+                (stats.f_blocks - stats.f_bfree) * stats.f_frsize,
+                stats.f_blocks * stats.f_frsize,
+                stats.f_files - stats.f_ffree,
+                nfspath
+                )
+            self.quotadict[record.key] = record
         
 # Catch all
 class unlisted_storage:
@@ -457,12 +915,40 @@ class unlisted_storage:
         self.systemname = name
         self.logfile = '/dev/null'
         self.quotadict = {}
+        self.freespace = None
+
 
+# Storage system types and the classes that collect from them
+BACKENDS = collections.OrderedDict((
+    ('vast', v_api),
+    ('qumulo', q_api),
+    ('isilon', i_api),
+    ('racktop', r_api),
+    ('nexenta', n_api),
+    ('generic', df_system),
+    ))
 
 ### Info Gathering and Parsing Functions
+def load_json_cache(cachepath):
+    '''Return the contents of a json cache file, or an empty dict if it is missing or unreadable'''
+    try:
+        with open(cachepath, 'r') as j:
+            return json.load(j)
+    except (OSError, ValueError) as excpt:
+        logging.info("Starting with an empty cache, could not read {}: {}".format(cachepath, excpt))
+        return {}
+
+def save_json_cache(cachepath, data):
+    '''Atomically replace a json cache file, so a crashed or overlapping run never leaves it half written'''
+    tmppath = '{}.{}.tmp'.format(cachepath, os.getpid())
+    try:
+        with open(tmppath, 'w') as j:
+            json.dump(data, j)
+        os.replace(tmppath, cachepath)
+    except OSError as excpt:
+        logging.warn("Could not write cache {}: {}".format(cachepath, excpt))
+
 def getconfig(configpath):
-    configdict = {}
-    custom_mapping = {}
     try:
         with open (configpath, 'r') as j:
             config = json.load(j)
@@ -470,96 +956,359 @@ def getconfig(configpath):
         for storagename in (
                 storagename for storagename in list(config['storagesystems'].keys()) if 'qumulo' in config['storagesystems'][storagename]['type']
             ):
-            config['storagesystems'][storagename]['port'] = 8000
+            config['storagesystems'][storagename].setdefault('port', 8000)
 
         group_dict = {}
         for lab,lab_info in config['groups'].items():
             group_dict[lab] = lab_info
-            if 'custom_mapping' in list(lab_info.keys()):
-                for storagesystem,cmname in lab_info['custom_mapping'].items():
-                    if cmname not in list(custom_mapping.keys()):
-                        custom_mapping[cmname] = {}
-                    custom_mapping[cmname][storagesystem] = lab
+
+        policy = notification_policy.load(config, configpath)
 
     except Exception as ex:
         logging.error(("Improperly formatted {} or missing file: ".format(configpath)))
         logging.error(ex)
         sys.exit(1)
         
-    return config, group_dict, custom_mapping
-
-def translate_path(toppath, systemname, nfsmapping, custom_mapping, groupdict):
-    lab = None
-    nfspath = None
-    application = ''
-    for mapping in (mapping for mapping in list(nfsmapping.keys()) if mapping in toppath):
-        labcandidate = os.path.relpath(toppath, mapping)
-        if labcandidate == '.':
+    return config, group_dict, policy
+
+alert_policy = collections.namedtuple('alert_policy', ('recipients', 'warn', 'full', 'templates', 'subjects'))
+
+class notification_policy:
+    '''Recipients, thresholds and templates for alerts, compiled once from the config'''
+    version = 1
+
+    def __init__(self, tables):
+        self.default = tables['default']
+        self.groups = tables['groups']
+        self.applications = tables['applications']
+        self.custom_mapping = tables['custom_mapping']
+        self.cache = {}
+
+    @classmethod
+    def load(cls, config, configpath):
+        cachepath = config.get('policy_cache', '/var/tmp/quotamonitor-policy.json')
+        stamp = [cls.version, os.path.abspath(configpath), os.stat(configpath).st_mtime_ns]
+        cached = load_json_cache(cachepath)
+        if cached.get('config') == stamp:
+            return cls(cached['tables'])
+        tables = cls.compile(config)
+        save_json_cache(cachepath, {'config':stamp, 'tables':tables})
+        return cls(tables)
+
+    @staticmethod
+    def compile(config):
+        '''Check the alerting settings and reduce them to json tables. Raises a
+        ValueError naming every bad value found.'''
+        problems = []
+
+        def percent(value, where):
             try:
-                quotaname = os.path.basename(os.path.normpath(toppath))
-                labcandidate = groupdict[quotaname]['custom_name'][systemname]
-            except:
-                logging.info(('Mapping not found for {}'.format(toppath)))
+                value = int(value)
+            except (TypeError, ValueError):
+                problems.append('{} must be a whole percentage, not {!r}'.format(where, value))
+                return 0
+            if value < 0:
+                problems.append('{} must not be negative'.format(where))
+            return value
+
+        def addresses(value, where):
+            if not isinstance(value, list) or not all(isinstance(address, str) for address in value):
+                problems.append('{} must be a list of addresses, not {!r}'.format(where, value))
+                return []
+            return value
+
+        email_settings = config.get('email_settings', {})
+        for setting in ('smtp_server', 'sender_address', 'template_path', 'default_recipient', 'default_alert_percent'):
+            if setting not in email_settings:
+                problems.append('email_settings has no {}'.format(setting))
+        if not isinstance(email_settings.get('subject', {}), dict):
+            problems.append('email_settings subject must map alert types to subjects')
+        default = {
+            'recipients':addresses(email_settings.get('default_recipient', []), 'email_settings default_recipient'),
+            'warn':percent(email_settings.get('default_alert_percent', 0), 'email_settings default_alert_percent'),
+            }
+
+        groups = {}
+        custom_mapping = {}
+        for lab, lab_info in config.get('groups', {}).items():
+            if not isinstance(lab_info, dict):
+                problems.append('group {} must be an object'.format(lab))
                 continue
-        if lab == None:
-            lab = labcandidate
-        elif len(labcandidate) < len(lab):
-            lab = labcandidate
-        nfspath = os.path.join(nfsmapping[mapping], lab)
-    
-    if lab in list(custom_mapping.keys()) and systemname in list(custom_mapping[lab].keys()):
-        lab = custom_mapping[lab][systemname]
+            groups[lab] = {
+                'recipients':addresses(lab_info.get('mail_to', []), 'group {} mail_to'.format(lab)),
+                'warn':percent(lab_info.get('warn_percent', default['warn']), 'group {} warn_percent'.format(lab)),
+                }
+            for limit in lab_info.get('soft_quota', {}).values():
+                try:
+                    int(limit)
+                except (TypeError, ValueError):
+                    problems.append('group {} soft_quota must be a whole number of terabytes, not {!r}'.format(lab, limit))
+            for storagesystem, cmname in lab_info.get('custom_mapping', {}).items():
+                custom_mapping.setdefault(cmname, {})[storagesystem] = lab
+
+        applications = {}
+        templates = ['warn.txt', 'full.txt', 'projected.txt']
+        for app, appconfig in config.get('application_shares', {}).items():
+            where = 'application share {}'.format(app)
+            subjects = appconfig.get('subject', {})
+            if not isinstance(subjects, dict):
+                problems.append('{} subject must map alert types to subjects'.format(where))
+                subjects = {}
+            applications[app] = {
+                'recipients':addresses(appconfig.get('addmail', []), '{} addmail'.format(where)),
+                'warn':percent(appconfig.get('warn_percent'), '{} warn_percent'.format(where)),
+                'full':percent(appconfig.get('full_percent'), '{} full_percent'.format(where)),
+                'subjects':subjects,
+                }
+            templates.extend(('{}warn.txt'.format(app), '{}full.txt'.format(app)))
+        if 'starfish' in config.get('storagesystems', {}):
+            templates.extend(('softwarn.txt', 'softfull.txt', 'softprojected.txt'))
+
+        if problems:
+            raise ValueError('; '.join(problems))
+
+        # A missing template only breaks the alerts that use it, so it is not fatal
+        for template in templates:
+            if not os.path.exists(os.path.join(email_settings['template_path'], template)):
+                logging.warn('Alert template {} is missing from {}'.format(template, email_settings['template_path']))
+
+        return {'default':default, 'groups':groups, 'applications':applications, 'custom_mapping':custom_mapping}
+
+    def resolve(self, lab, application):
+        '''The alert_policy for a quota, worked out once per distinct group and application'''
+        key = (lab if lab in self.groups else None, application)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        recipients = list(self.default['recipients'])
+        warn = self.default['warn']
+        full = 100
+        subjects = {}
+        share = self.applications.get(application) if application not in ('', 'soft') else None
+        if share is not None:
+            recipients.extend(share['recipients'])
+        if key[0] is not None:
+            recipients.extend(self.groups[lab]['recipients'])
+            warn = self.groups[lab]['warn']
+        if share is not None:
+            warn = share['warn']
+            full = share['full']
+            subjects = share['subjects']
+            # Application shares have their own warn and full templates, but share the projected one
+            templates = {'warn':'{}warn.txt'.format(application), 'full':'{}full.txt'.format(application), 'projected':'projected.txt'}
+        else:
+            templates = {mailtype:'{}{}.txt'.format(application, mailtype) for mailtype in ('warn', 'full', 'projected')}
+        self.cache[key] = alert_policy(recipients, warn, full, templates, subjects)
+        return self.cache[key]
+
+class path_index:
+    '''Resolves storage paths to (lab, nfspath, application), compiled once from the config'''
+    def __init__(self, config, groupdict, custom_mapping):
+        self.groupdict = groupdict
+        self.custom_mapping = custom_mapping
+        self.mappings = {}
+        for source, sysconfig in config['storagesystems'].items():
+            trie = self.mappings.setdefault(source, {})
+            for mapping, nfsroot in sysconfig.get('nfsmapping', {}).items():
+                self.insert(trie, mapping, nfsroot)
+        self.applications = {}
+        for app, appconfig in config.get('application_shares', {}).items():
+            for systemname, prefix in appconfig['storageprefix'].items():
+                self.insert(self.applications.setdefault(systemname, {}), prefix, app)
+        self.cache = {}
 
-    if lab in list(groupdict.keys()):
-        labdict = groupdict[lab]
-        if 'custom_name' in list(labdict.keys()) and systemname in list(labdict['custom_name'].keys()):
+    @staticmethod
+    def split(path):
+        return [part for part in path.split('/') if part and part != '.']
+
+    def insert(self, trie, path, value):
+        node = trie
+        for part in self.split(path):
+            node = node.setdefault(part, {})
+        # Path components are never None, so it is safe to use as the value slot
+        node[None] = value
+
+    @staticmethod
+    def walk(trie, parts):
+        '''Return [(depth, value)] for every prefix of parts present in trie, shallowest first'''
+        matches = []
+        node = trie
+        if None in node:
+            matches.append((0, node[None]))
+        for depth, part in enumerate(parts, 1):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                matches.append((depth, node[None]))
+        return matches
+
+    def resolve(self, toppath, systemname, mapsource=None):
+        key = (toppath, systemname, mapsource)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        parts = self.split(toppath)
+        lab = None
+        nfspath = None
+        for depth, nfsroot in reversed(self.walk(self.mappings.get(mapsource or systemname, {}), parts)):
+            if depth < len(parts):
+                lab = '/'.join(parts[depth:])
+            else:
+                # The quota is the mapped directory itself, so only a custom_name can name it
+                try:
+                    lab = self.groupdict[parts[-1]]['custom_name'][systemname]
+                except (KeyError, IndexError, TypeError):
+                    logging.info(('Mapping not found for {}'.format(toppath)))
+                    continue
+            nfspath = os.path.join(nfsroot, lab)
+            break
+
+        if systemname in self.custom_mapping.get(lab, {}):
+            lab = self.custom_mapping[lab][systemname]
+
+        labdict = self.groupdict.get(lab)
+        if nfspath is not None and labdict is not None and systemname in labdict.get('custom_name', {}):
             nfspath = os.path.join(os.path.dirname(nfspath), labdict['custom_name'][systemname])
 
-    for app in list(configdict['application_shares'].keys()):
-        prefix = configdict['application_shares'][app]['storageprefix']
-        if prefix.get(systemname, 'NONE') in toppath:
-            application = app
-    return lab, nfspath, application
+        applications = self.walk(self.applications.get(systemname, {}), parts)
+        application = applications[-1][1] if applications else ''
+        self.cache[key] = (lab, nfspath, application)
+        return lab, nfspath, application
 
+def translate_path(toppath, systemname, mapsource=None):
+    '''Translate a storage path into (lab, nfspath, application). mapsource names the
+    storagesystems entry whose nfsmapping applies, if it is not systemname itself.'''
+    return pathindex.resolve(toppath, systemname, mapsource)
+
+
+def run_with_deadlines(tasks, workers):
+    '''Run each task in tasks ({name: (callable, timeout)}) on a pool of at most
+    workers threads. Each task gets its own deadline, counted from when it starts.
+    A task that overruns is abandoned (its daemon thread is left behind) so that
+    one hung system cannot hold up the rest. Returns {name: status dict}.'''
+    status = {}
+    slots = threading.BoundedSemaphore(max(1, int(workers)))
+
+    def runner(name, func, timeout):
+        result = {'status':'failed', 'seconds':0.0, 'error':None}
+        status[name] = result
+        # The worker reports into its own dict, so an abandoned one that finishes
+        # late cannot turn a timeout into a success
+        outcome = {'status':'failed', 'error':None}
+
+        def call():
+            try:
+                runreport.call(func)
+                outcome['status'] = 'ok'
+            except BaseException as excpt:
+                outcome['error'] = excpt
+        with slots:
+            start = time()
+            worker = threading.Thread(target=call, name='collect-{}'.format(name), daemon=True)
+            worker.start()
+            worker.join(timeout)
+            result['seconds'] = time() - start
+            if worker.is_alive():
+                result['status'] = 'timeout'
+                result['error'] = 'no result after {}s'.format(timeout)
+            else:
+                result.update(outcome)
+
+    runners = []
+    for name, (func, timeout) in tasks.items():
+        thread = threading.Thread(target=runner, args=(name, func, timeout), daemon=True)
+        thread.start()
+        runners.append(thread)
+    for thread in runners:
+        thread.join()
+    return status
+
+def createbackend(systemname, config):
+    '''Return the backend object for a storagesystems entry, or None if it is not a
+    quota source. The vendor modules a backend needs are imported here, the first
+    time a system of that type is configured.'''
+    backend = BACKENDS.get(config['type'])
+    if backend is None:
+        # Fall back to the older substring match, so types like "vast5" still work
+        backend = next((cls for key, cls in BACKENDS.items() if key in config['type']), None)
+    if backend is None:
+        return None
+    try:
+        for module in backend.requires:
+            importlib.import_module(module)
+    except ImportError as ex:
+        logging.error("Cannot monitor {}, a module for {} is missing: {}".format(systemname, config['type'], ex))
+        return None
+    return backend(systemname, config)
+
+def peak_memory():
+    '''Peak resident memory of this process in MB (ru_maxrss is in KB on Linux)'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def logstartup(systemnames):
+    runreport.startup = time() - STARTTIME
+    logging.info("Loaded backends for {} in {:.2f}s, peak memory {:.1f} MB".format(
+        ', '.join(systemnames), time() - STARTTIME, peak_memory()))
+
+def logcollection(systemname, result):
+    '''Log how the collection from one system went, and return whether it succeeded'''
+    requeststats = httppool.stats.get(systemname)
+    if requeststats:
+        logging.info("{}: {} requests ({} errors), {:.1f}s waiting, {} bytes received".format(
+            systemname, requeststats['requests'], requeststats['errors'], requeststats['seconds'], requeststats['bytes']))
+    if result['status'] == 'ok':
+        logging.info("Gathered quotas from {} in {:.1f}s".format(systemname, result['seconds']))
+        return True
+    logging.error("Could not get quotas for {} ({} after {:.1f}s): {}".format(
+        systemname, result['status'], result['seconds'], result['error']))
+    return False
 
 def buildsystemdict(custom_mapping, groupdict):
+    global collectionstats
     systemdict = {}
+    collection_settings = configdict.get('collection_settings', {})
+    default_timeout = collection_settings.get('timeout', 900)
+    tasks = {}
     for systemname, config in configdict['storagesystems'].items():
-        if 'vast' in config['type']:
-            systemdict[systemname] = v_api(systemname, config)
-        
-        elif 'qumulo' in config['type']:
-            systemdict[systemname] = q_api(systemname, config)
-    
-        elif 'isilon' in config['type']:
-            systemdict[systemname] = i_api(systemname, config)
+        backend = createbackend(systemname, config)
+        if backend is None:
+            continue
+        systemdict[systemname] = backend
+        runreport.instrument(backend)
 
-        elif 'racktop' in config['type']:
-            systemdict[systemname] = r_api(systemname, config)
-            
-        elif 'nexenta' in config['type']:
-            systemdict[systemname] = n_api(systemname, config)
+        def collect(system=systemdict[systemname]):
+            system.process_quotas(custom_mapping, groupdict)
+        tasks[systemname] = (collect, config.get('timeout', default_timeout))
+    logstartup(list(systemdict.keys()))
 
-        elif 'generic' in config['type']:
-            systemdict[systemname] = df_system(systemname, config)
-            
-        try:
-            systemdict[systemname].process_quotas(custom_mapping, groupdict)
-            logging.info("Gathered quotas from {}".format(systemname))
-        except Exception as ex:
-            logging.error("Could not get quotas for {}: {}".format(systemname, ex))
+    starfish = None
+    if 'starfish' in configdict['storagesystems']:
+        starfish = sf_api(configdict['storagesystems']['starfish'])
+        runreport.instrument(starfish)
+        tasks['starfish'] = (
+            lambda: get_soft_quotas(starfish, custom_mapping, groupdict),
+            configdict['storagesystems']['starfish'].get('timeout', default_timeout)
+            )
 
-    try:        
-        systemdict = get_soft_quotas(systemdict, custom_mapping, groupdict)
-    except Exception as ex:
-        logging.warning("Could not get soft quotas: {}".format(ex))
-        
+    collectionstats = run_with_deadlines(tasks, collection_settings.get('workers', len(tasks)))
+    for systemname, result in collectionstats.items():
+        if not logcollection(systemname, result):
+            # Drop anything a failed or abandoned collector may have left half built,
+            # and keep the last good csv for this system in place
+            if systemname in systemdict:
+                systemdict[systemname] = unlisted_storage(systemname)
+
+    if starfish is not None and collectionstats['starfish']['status'] == 'ok':
+        systemdict = merge_soft_quotas(systemdict, starfish.softquotadict)
 
     return systemdict
 
-def get_soft_quotas(systemdict, custom_mapping, groupdict):
-    starfish = sf_api(configdict['storagesystems']['starfish'])
-    starfish.login()
+def get_soft_quotas(starfish, custom_mapping, groupdict):
+    if not starfish.loggedin:
+        starfish.login()
     volpathlimits = {}
     for group in (group for group in list(groupdict.keys()) if 'soft_quota' in list(groupdict[group].keys())):
         for storage, limit in groupdict[group]['soft_quota'].items():
@@ -567,135 +1316,555 @@ def get_soft_quotas(systemdict, custom_mapping, groupdict):
             volpathlimits[vol_path] = int(limit)
     starfish.get_all_quotas(volpathlimits)
     starfish.process_quotas(custom_mapping, groupdict)
-    for volume, entry in starfish.softquotadict.items():
+
+def merge_soft_quotas(systemdict, softquotadict):
+    for volume, entry in softquotadict.items():
         if volume not in list(systemdict.keys()):
             systemdict[volume] = unlisted_storage(volume)
-        for lab, quota in entry.items():
-            systemdict[volume].quotadict[lab] = quota
+        systemdict[volume].quotadict.update(entry)
     return systemdict
 
 ### LogFile Functions ###
 
-def buildloglist():
-    loglist = {}
-    
+def csvrows(obj):
+    '''The rows of a system's csv: free space (or an empty row if the system does
+    not report it), then its quotas in order'''
+    rows = sorted(record.row() for record in obj.quotadict.values())
+    free = obj.freespace
+    rows.insert(0, ['FREE', free.freesize, free.totalsize] if free is not None else [])
+    return rows
+
+def writecsvs(systems=None):
+    '''Write the csv of each system in systemdict, or only of those in systems if it is given
+    (a csv that does not exist yet is always written)'''
+    written = 0
     for system, obj in systemdict.items():
-        freelist = []
-        loglist[system] = []
-        for lab, linfo in obj.quotadict.items():
-            try:
-                if lab == 'FREE':
-                    freelist = ['FREE', linfo['freesize'], linfo['totalsize']]
-                    continue
-                lab = lab.replace('--{}'.format(linfo['special']),'')
-                loglist[system].append([lab, linfo['usage'], linfo['quota'], linfo['total_files'], linfo['special']])
-            except Exception as excpt:
-                logging.warn(("Could not build list for {} on {}".format(lab, system)))
-                logging.warn(linfo)
-                logging.warn(excpt)
-        loglist[system].sort()
-        loglist[system].insert(0,freelist)
-    return loglist
-
-def writecsvs(loglist):
-    for system in list(loglist.keys()):
+        if systems is not None and system not in systems and os.path.exists(obj.logfile):
+            continue
         try:
-            with open (systemdict[system].logfile,'w') as f:
+            with open (obj.logfile,'w') as f:
                 header = 'Lab,SpaceUsed,TotalSpace,TotalFile'
                 f.write(header + '\n')
                 csv_writer = csv.writer(f)
-                csv_writer.writerows(loglist[system])
+                csv_writer.writerows(csvrows(obj))
+            written += 1
         except Exception as excpt:
             logging.warn(("Unable to write log file for {}".format(system)))
             logging.warn(excpt)
+    return written
+
+### Snapshot Functions ###
+
+def load_snapshot(snapshotpath):
+    '''Return the snapshot saved by the last run, or an empty one'''
+    try:
+        with gzip.open(snapshotpath, 'rt') as j:
+            return json.load(j)
+    except (OSError, ValueError) as excpt:
+        logging.info("No previous snapshot, processing everything: {}".format(excpt))
+        return {'date':None, 'systems':{}}
+
+def save_snapshot(snapshotpath, snapshot):
+    tmppath = '{}.{}.tmp'.format(snapshotpath, os.getpid())
+    try:
+        with gzip.open(tmppath, 'wt') as j:
+            json.dump(snapshot, j, separators=(',', ':'))
+        os.replace(tmppath, snapshotpath)
+    except OSError as excpt:
+        logging.warn("Could not save snapshot {}: {}".format(snapshotpath, excpt))
+
+def buildsnapshot(previous):
+    '''Reduce systemdict to {system: {lab: [usage, quota, total_files, nfspath, special]}},
+    with each system's [freesize, totalsize] (or None) under 'free'.
+    A system that could not be collected this time keeps its previous entries.
+    'collected' holds the time each system was last collected successfully, and
+    'inserted' the date each system last had all of its quotas put in the db.'''
+    systems = {}
+    free = {}
+    collected = dict(previous.get('collected', {}))
+    now = time()
+    for system, obj in systemdict.items():
+        result = collectionstats.get(system)
+        if result is not None and result['status'] != 'ok':
+            if system in previous['systems']:
+                systems[system] = previous['systems'][system]
+                free[system] = previous.get('free', {}).get(system)
+                continue
+        else:
+            collected[system] = now
+        free[system] = [obj.freespace.freesize, obj.freespace.totalsize] if obj.freespace is not None else None
+        systems[system] = {
+            key:[record.usage, record.quota, record.files, record.nfspath, record.application]
+            for key, record in obj.quotadict.items()
+            }
+    return {'date':str(datetime.now().date()), 'systems':systems, 'free':free, 'collected':collected,
+            'inserted':dict(previous.get('inserted', {}))}
+
+def diffsnapshot(previous, current):
+    '''Return {system: {'added':set, 'removed':set, 'changed':set}} of quota keys,
+    with 'free' set when the system's free space changed'''
+    delta = {}
+    for system, quotas in current['systems'].items():
+        old = previous['systems'].get(system, {})
+        delta[system] = {
+            'added':set(lab for lab in quotas if lab not in old),
+            'removed':set(lab for lab in old if lab not in quotas),
+            'changed':set(lab for lab in quotas if lab in old and old[lab] != quotas[lab]),
+            'free':current['free'].get(system) != previous.get('free', {}).get(system),
+            }
+    return delta
+
+def changedsystems(delta):
+    '''Systems with any added, removed or changed quota, or a change in free space,
+    or None when there is no delta'''
+    if delta is None:
+        return None
+    return set(system for system, entry in delta.items() if entry['added'] or entry['removed'] or entry['changed'] or entry['free'])
+
+def changedquotas(delta):
+    '''{system: set of added or changed quota keys}, or None when there is no delta'''
+    if delta is None:
+        return None
+    return {system:entry['added'] | entry['changed'] for system, entry in delta.items()}
+
+### History Functions ###
+
+class history_store:
+    '''Append-only history of every collection, one directory per system and one file per sample'''
+    COLUMNS = ('id', 'usage', 'quota', 'total_files')
+
+    def __init__(self, historypath):
+        self.historypath = historypath
+        self.labcache = {}
+
+    def systempath(self, system):
+        return os.path.join(self.historypath, system)
+
+    def labids(self, system, labs=()):
+        '''Return {lab: id} for system, giving ids to any of labs that do not have one yet'''
+        known = self.labcache.setdefault(system, {})
+        missing = [lab for lab in labs if lab not in known]
+        if known and not missing:
+            return known
+        os.makedirs(self.systempath(system), exist_ok=True)
+        with open(os.path.join(self.systempath(system), 'labs.txt'), 'a+') as f:
+            # Another run may be adding labs too, so reread the file under the lock
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            for labid, line in enumerate(f):
+                known[line.rstrip('\n')] = labid
+            for lab in missing:
+                if lab not in known:
+                    known[lab] = len(known)
+                    f.write(lab + '\n')
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return known
+
+    def labnames(self, system):
+        '''Return the quota keys of system, indexed by id'''
+        ids = self.labids(system)
+        names = [None] * len(ids)
+        for lab, labid in ids.items():
+            names[labid] = lab
+        return names
+
+    def append(self, system, timestamp, quotadict, free=None):
+        '''Store one sample of quotadict (and free, the system's free_space) for
+        system, taken at timestamp'''
+        ids = self.labids(system, list(quotadict))
+        rows = sorted((ids[key], record) for key, record in quotadict.items())
+        sortedids = [row[0] for row in rows]
+        columns = (
+            array('q', [labid - previous for labid, previous in zip(sortedids, [0] + sortedids[:-1])]),
+            array('q', [row[1].usage for row in rows]),
+            array('q', [row[1].quota for row in rows]),
+            array('q', [row[1].files for row in rows]),
+            )
+        blobs = [zlib.compress(column.tobytes()) for column in columns]
+        header = {
+            'time':int(timestamp),
+            'count':len(rows),
+            'free':[int(free.freesize), int(free.totalsize)] if free else None,
+            'sizes':[len(blob) for blob in blobs],
+            }
+        daypath = os.path.join(self.systempath(system), datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d'))
+        os.makedirs(daypath, exist_ok=True)
+        samplepath = os.path.join(daypath, '{}.qh'.format(int(timestamp)))
+        tmppath = '{}.{}.tmp'.format(samplepath, os.getpid())
+        with open(tmppath, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmppath, samplepath)
+
+    def stamps(self, system, start=None, end=None):
+        '''Return the times of the samples of system taken between start and end
+        (unix times, inclusive), oldest first, without reading the samples'''
+        systempath = self.systempath(system)
+        if not os.path.isdir(systempath):
+            return []
+        firstday = datetime.fromtimestamp(start, timezone.utc).strftime('%Y-%m-%d') if start is not None else ''
+        lastday = datetime.fromtimestamp(end, timezone.utc).strftime('%Y-%m-%d') if end is not None else '9999'
+        stamps = []
+        for day in sorted(os.listdir(systempath)):
+            if not (firstday <= day <= lastday) or not os.path.isdir(os.path.join(systempath, day)):
+                continue
+            stamps.extend(sorted(
+                stamp for stamp in (int(name[:-3]) for name in os.listdir(os.path.join(systempath, day)) if name.endswith('.qh'))
+                if (start is None or stamp >= start) and (end is None or stamp <= end)
+                ))
+        return stamps
+
+    def sample(self, system, stamp):
+        '''Return (header, id, usage, quota, total_files) for the sample of system taken at stamp'''
+        day = datetime.fromtimestamp(stamp, timezone.utc).strftime('%Y-%m-%d')
+        with open(os.path.join(self.systempath(system), day, '{}.qh'.format(stamp)), 'rb') as f:
+            header = json.loads(f.readline())
+            columns = []
+            for size in header['sizes']:
+                column = array('q')
+                column.frombytes(zlib.decompress(f.read(size)))
+                columns.append(column)
+        columns[0] = array('q', accumulate(columns[0]))
+        return (header,) + tuple(columns)
+
+    def samples(self, system, start=None, end=None):
+        '''Yield (header, id, usage, quota, total_files) for each sample of system
+        taken between start and end (unix times, inclusive), oldest first'''
+        for stamp in self.stamps(system, start, end):
+            yield self.sample(system, stamp)
+
+    def read(self, system, lab=None, start=None, end=None):
+        '''Return [(time, lab, usage, quota, total_files)] for one system, or one lab on it'''
+        names = self.labnames(system)
+        wanted = self.labids(system).get(lab) if lab is not None else None
+        if lab is not None and wanted is None:
+            return []
+        history = []
+        for header, ids, usage, quota, files in self.samples(system, start, end):
+            if wanted is None:
+                rows = range(len(ids))
+            else:
+                row = bisect_left(ids, wanted)
+                rows = [row] if row < len(ids) and ids[row] == wanted else []
+            for row in rows:
+                history.append((header['time'], names[ids[row]], usage[row], quota[row], files[row]))
+        return history
+
+def softhistoryname(system):
+    '''The history name under which the Starfish soft quotas of system are kept'''
+    return '{}.soft'.format(system)
+
+def appendhistory(history, system, timestamp, quotadict, free=None):
+    try:
+        history.append(system, timestamp, quotadict, free)
+    except (OSError, KeyError, ValueError) as excpt:
+        logging.warn("Could not record history for {}: {}".format(system, excpt))
+
+def recordhistory(history):
+    '''Append the current quotas of each collected system to the history. Soft
+    quotas go in samples of their own, under softhistoryname(system), since
+    they are collected separately from the system's hard quotas.'''
+    now = time()
+    for system, obj in systemdict.items():
+        result = collectionstats.get(system)
+        if result is not None and result['status'] == 'ok':
+            hard = {key:record for key, record in obj.quotadict.items() if record.application != 'soft'}
+            appendhistory(history, system, now, hard, obj.freespace)
+        soft = {key:record for key, record in obj.quotadict.items() if record.application == 'soft'}
+        if soft:
+            appendhistory(history, softhistoryname(system), now, soft)
+
+### Forecast Functions ###
+
+def forecast_system(np, history, system, start, end, minsamples):
+    '''Fit a straight line to the usage of every quota of system between start and
+    end, all quotas at once, and return {quota key: seconds until full} for the
+    quotas that are growing. The sums for the least squares fit are gathered one
+    sample at a time, so memory stays proportional to the number of quotas.
+    Times are in hours before the newest sample and usage is relative to it,
+    to keep the sums well conditioned, so the newest sample is read first.'''
+    stamps = history.stamps(system, start, end)
+    if len(stamps) < minsamples:
+        return {}
+    nlabs = len(history.labids(system))
+    header, ids, usage, quota, files = history.sample(system, stamps[-1])
+    latest = np.frombuffer(ids, dtype=np.int64)
+    present = np.zeros(nlabs, dtype=bool)
+    present[latest] = True
+    current = np.zeros(nlabs)
+    current[latest] = np.frombuffer(usage, dtype=np.int64)
+    limit = np.zeros(nlabs)
+    limit[latest] = np.frombuffer(quota, dtype=np.int64)
+
+    count, sumt, sumu, sumtt, sumtu = (np.zeros(nlabs) for i in range(5))
+    for stamp in stamps:
+        sampleheader, ids, usage, quota, files = history.sample(system, stamp)
+        ids = np.frombuffer(ids, dtype=np.int64)
+        hours = (sampleheader['time'] - header['time']) / 3600.0
+        used = np.frombuffer(usage, dtype=np.int64) - current[ids]
+        count[ids] += 1
+        sumt[ids] += hours
+        sumu[ids] += used
+        sumtt[ids] += hours * hours
+        sumtu[ids] += hours * used
+
+    denominator = count * sumtt - sumt * sumt
+    fitted = present & (count >= minsamples) & (denominator > 0) & (limit > 0)
+    slope = np.zeros(nlabs)
+    slope[fitted] = (count[fitted] * sumtu[fitted] - sumt[fitted] * sumu[fitted]) / denominator[fitted]
+    growing = np.nonzero(fitted & (slope > 0))[0]
+    hoursleft = np.maximum((limit[growing] - current[growing]) / slope[growing], 0)
+    names = history.labnames(system)
+    return {names[labid]:left * 3600 for labid, left in zip(growing.tolist(), hoursleft.tolist())}
+
+def forecastall(history, forecast_settings):
+    '''Forecast every system in systemdict from the history, or return None if numpy is missing'''
+    try:
+        np = importlib.import_module('numpy')
+    except ImportError:
+        logging.warning('numpy is not installed, skipping projected full alerts')
+        return None
+    start = time()
+    window = forecast_settings.get('window_hours', 24) * 3600
+    minsamples = forecast_settings.get('min_samples', 4)
+    forecasts = {}
+    for system in systemdict:
+        try:
+            forecasts[system] = forecast_system(np, history, system, start - window, start, minsamples)
+            # A soft quota replaces the hard quota with the same key in systemdict, and so does its forecast
+            forecasts[system].update(forecast_system(np, history, softhistoryname(system), start - window, start, minsamples))
+        except (OSError, ValueError, zlib.error) as excpt:
+            logging.warn("Could not forecast {}: {}".format(system, excpt))
+    logging.info("Forecast {} growing quotas in {:.2f}s".format(sum(len(entry) for entry in forecasts.values()), time() - start))
+    return forecasts
+
+### Metrics Functions ###
+
+def metriclabels(**labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in labels.items())
+
+def buildmetrics(lastsuccess):
+    '''Render the quotas in systemdict, and the health of each collector, in the
+    Prometheus text exposition format. lastsuccess is {system: unix time}.'''
+    families = collections.OrderedDict((
+        ('quotamonitor_quota_used_bytes', ('gauge', 'Space used by the quota')),
+        ('quotamonitor_quota_limit_bytes', ('gauge', 'Hard limit of the quota')),
+        ('quotamonitor_quota_files', ('gauge', 'Files in the quota')),
+        ('quotamonitor_system_free_bytes', ('gauge', 'Free space on the storage system')),
+        ('quotamonitor_system_size_bytes', ('gauge', 'Total size of the storage system')),
+        ('quotamonitor_collector_up', ('gauge', 'Whether the last collection from the system succeeded')),
+        ('quotamonitor_collector_duration_seconds', ('gauge', 'Time taken by the last collection from the system')),
+        ('quotamonitor_collector_last_success_timestamp_seconds', ('gauge', 'Unix time of the last successful collection')),
+        ('quotamonitor_collector_api_requests_total', ('counter', 'REST requests made to the system')),
+        ('quotamonitor_collector_api_errors_total', ('counter', 'REST requests to the system that failed')),
+        ('quotamonitor_collector_api_seconds_total', ('counter', 'Time spent waiting on REST requests to the system')),
+        ('quotamonitor_mount_stale', ('gauge', 'Mounts that did not answer in time on the last collection')),
+        ))
+    samples = dict((name, []) for name in families)
+    for system, obj in systemdict.items():
+        if obj.freespace is not None:
+            labels = metriclabels(system=system)
+            samples['quotamonitor_system_free_bytes'].append((labels, obj.freespace.freesize))
+            samples['quotamonitor_system_size_bytes'].append((labels, obj.freespace.totalsize))
+        for record in obj.quotadict.values():
+            labels = metriclabels(system=system, lab=record.lab, application=record.application, path=record.nfspath)
+            samples['quotamonitor_quota_used_bytes'].append((labels, record.usage))
+            samples['quotamonitor_quota_limit_bytes'].append((labels, record.quota))
+            samples['quotamonitor_quota_files'].append((labels, record.files))
+    for system, result in collectionstats.items():
+        labels = metriclabels(system=system)
+        samples['quotamonitor_collector_up'].append((labels, int(result['status'] == 'ok')))
+        samples['quotamonitor_collector_duration_seconds'].append((labels, result['seconds']))
+        for mount in getattr(systemdict.get(system), 'stale', ()):
+            samples['quotamonitor_mount_stale'].append((metriclabels(system=system, mount=mount), 1))
+    for system, stamp in lastsuccess.items():
+        samples['quotamonitor_collector_last_success_timestamp_seconds'].append((metriclabels(system=system), stamp))
+    for system, stats in list(httppool.stats.items()):
+        labels = metriclabels(system=system)
+        samples['quotamonitor_collector_api_requests_total'].append((labels, stats['requests']))
+        samples['quotamonitor_collector_api_errors_total'].append((labels, stats['errors']))
+        samples['quotamonitor_collector_api_seconds_total'].append((labels, stats['seconds']))
+
+    lines = []
+    for name, (metrictype, helptext) in families.items():
+        lines.append('# HELP {} {}'.format(name, helptext))
+        lines.append('# TYPE {} {}'.format(name, metrictype))
+        lines.extend('{}{{{}}} {}'.format(name, labels, value) for labels, value in samples[name])
+    return '\n'.join(lines) + '\n'
+
+def writemetrics(textfile, lastsuccess):
+    '''Write the metrics for the node_exporter textfile collector, atomically so it never reads half a file'''
+    tmppath = '{}.{}.tmp'.format(textfile, os.getpid())
+    try:
+        with open(tmppath, 'w') as f:
+            f.write(buildmetrics(lastsuccess))
+        os.replace(tmppath, textfile)
+    except OSError as excpt:
+        logging.warn("Could not write metrics to {}: {}".format(textfile, excpt))
+
+def servemetrics(port, lastsuccess):
+    '''Serve the metrics over http on port from a background thread'''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class metricshandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = buildmetrics(lastsuccess).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    server = ThreadingHTTPServer(('', port), metricshandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info("Serving metrics on port {}".format(port))
+    return server
 
 ### Email Functions ###
 
-def process_emails(default_recipient, default_alert_percent, groupdict):
+class alert_state:
+    '''Remembers which quotas have already been alerted on, in one SQLite table'''
+    def __init__(self, statepath):
+        self.statepath = statepath
+        self.sent = {}
+        self.added = {}
+        self.removed = set()
+
+    def open(self):
+        '''Take the write lock and read the state. Raises sqlite3.OperationalError
+        if another run holds the lock for longer than the timeout.'''
+        self.con = sqlite3.connect(self.statepath, timeout=300, isolation_level=None)
+        try:
+            self.con.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error:
+            self.con.close()
+            raise
+        self.con.execute(
+            'CREATE TABLE IF NOT EXISTS alerts (System TEXT, Special TEXT, Lab TEXT, Type TEXT, Sent REAL, '
+            'PRIMARY KEY (System, Special, Lab, Type))'
+            )
+        self.sent = {tuple(row[:4]):row[4] for row in self.con.execute('SELECT System, Special, Lab, Type, Sent FROM alerts')}
+
+    def commit(self):
+        self.con.executemany('DELETE FROM alerts WHERE System=? AND Special=? AND Lab=? AND Type=?', self.removed)
+        self.con.executemany('INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?)', [key + (sent,) for key, sent in self.added.items()])
+        self.con.execute('COMMIT')
+
+    def close(self):
+        '''Release the lock, dropping any changes that were not committed'''
+        try:
+            if self.con.in_transaction:
+                self.con.execute('ROLLBACK')
+        finally:
+            self.con.close()
+
+    def is_sent(self, key):
+        return key in self.sent
+
+    def has_alerts(self, key):
+        '''Whether any alert is outstanding for (system, special, lab)'''
+        return any(key + (alerttype,) in self.sent for alerttype in ('warn', 'full', 'projected'))
+
+    def mark(self, key):
+        self.sent[key] = self.added[key] = time()
+        self.removed.discard(key)
+
+    def clear(self, key):
+        if key in self.sent:
+            del self.sent[key]
+            self.added.pop(key, None)
+            self.removed.add(key)
+
+    def expire(self, key, daysback):
+        '''Forget an alert sent more than daysback days ago, so it will be sent again'''
+        if key in self.sent and time() - self.sent[key] > timedelta(days=daysback).total_seconds():
+            self.clear(key)
+
+def process_emails(policy, alertstate, only=None, forecasts=None, horizon=0):
+    '''Build the list of alerts to send. If only ({system: set of quota keys}) is given,
+    other quotas are skipped unless they already have an alert outstanding, so
+    that their re-notify and clear-down still happen. forecasts ({system: {quota
+    key: seconds until full}}) adds projected alerts for quotas below their warn
+    threshold that will fill within horizon seconds.'''
     maillist = []
+    projected = {}
+    if forecasts is not None:
+        projected = {system:set(lab for lab, left in entry.items() if left <= horizon) for system, entry in forecasts.items()}
     for system, obj in systemdict.items():
-        for lab, linfo in obj.quotadict.items():
-            recipient = []
-            recipient.extend(default_recipient)
-            if 'FREE' in lab:
+        for key, record in obj.quotadict.items():
+            if only is not None and key not in only.get(system, ()) and key not in projected.get(system, ()) and \
+                    not alertstate.has_alerts((system, record.application, os.path.basename(key))):
                 continue
-            elif linfo['special'] != '':
-                groupkey = lab.replace('--{}'.format(linfo['special']),'')
-            else:
-                groupkey = lab
-
-            if linfo['special'] not in ('', 'soft'):
-                recipient.extend(configdict['application_shares'][linfo['special']]['addmail'])
-                
-            labdict = obj.quotadict[lab]
-            if groupkey in list(groupdict.keys()):
-                labconfig = groupdict[groupkey]
-                emailtype, checkfile, percentage = check_percentage(system, lab, labdict, int(labconfig['warn_percent']), configdict['application_shares'])
-                recipient.extend(labconfig['mail_to'])
-            elif labdict['quota'] != 0:
-                emailtype, checkfile, percentage = check_percentage(system, lab, labdict, default_alert_percent, configdict['application_shares'])
+
+            quotapolicy = policy.resolve(record.lab, record.application)
+            emailtype = ''
+            if record.quota != 0:
+                emailtype, statekey, percentage = check_percentage(system, record, quotapolicy, alertstate)
+
+            hoursleft = None
+            if forecasts is not None and emailtype == '' and record.quota != 0:
+                emailtype, statekey, hoursleft = check_projection(system, record, forecasts.get(system, {}).get(key), horizon, alertstate)
 
             if emailtype != '':
-                if not os.path.isfile(checkfile):
-                    with open(checkfile, "a+") as f:
-                        pass
+                if not alertstate.is_sent(statekey):
+                    alertstate.mark(statekey)
                     maillist.append({
-                        'nfspath':labdict['nfspath'], 
+                        'nfspath':record.nfspath, 
                         'system':system, 
-                        'quotaname':lab, 
-                        'usage':'{:.2f}'.format(float(labdict['usage']) / TERABYTE), 
-                        'quota':'{:.2f}'.format(float(labdict['quota']) / TERABYTE), 
-                        'mailto':recipient,
+                        'quotaname':key, 
+                        'usage':'{:.2f}'.format(float(record.usage) / TERABYTE), 
+                        'quota':'{:.2f}'.format(float(record.quota) / TERABYTE), 
+                        'mailto':quotapolicy.recipients,
                         'mailtype':emailtype,
                         'percentage':'{:.2f}'.format(percentage),
-                        'special':labdict['special']
+                        'hours':'{:.1f}'.format(hoursleft) if hoursleft is not None else '',
+                        'special':record.application,
+                        'policy':quotapolicy
                         })
 
     return maillist
         
-def check_percentage(system, lab, labdict, warn_percent, application_shares):
-    percentage = 100 * labdict['usage'] / labdict['quota']
-    checkfileroot = os.path.join('/tmp', '{}{}-{}-t'.format(labdict['special'], system, os.path.basename(lab)))
+def check_percentage(system, record, quotapolicy, alertstate):
+    percentage = 100 * record.usage / record.quota
+    statekey = (system, record.application, os.path.basename(record.key))
     emailtype = ''
-    checkfile = ''
-    fullcheckfile = checkfileroot + '-full'
-    warncheckfile = checkfileroot + '-warn'
+    fullkey = statekey + ('full',)
+    warnkey = statekey + ('warn',)
     # pass age limits in days
-    cleanupfiles(fullcheckfile, 1)
-    cleanupfiles(warncheckfile, 7)
-
-    if labdict['special'] in list(application_shares.keys()):
-        warn_percent = int(application_shares[labdict['special']]['warn_percent'])
-        full_percent = int(application_shares[labdict['special']]['full_percent'])
-    else:
-        full_percent = 100
+    alertstate.expire(fullkey, 1)
+    alertstate.expire(warnkey, 7)
 
+    warn_percent = quotapolicy.warn
+    full_percent = quotapolicy.full
     if percentage >= warn_percent and percentage < full_percent:
         emailtype = 'warn'
-        checkfile = warncheckfile
+        statekey = warnkey
     elif percentage >= full_percent:
-        checkfile = fullcheckfile
+        statekey = fullkey
         emailtype = 'full'
-        try:
-            os.remove(warncheckfile)
-        except:
-            pass
+        alertstate.clear(warnkey)
     else:
-        try:
-            os.remove(warncheckfile)
-            os.remove(fullcheckfile)
-        except:
-            pass
-    return emailtype, checkfile, percentage
+        alertstate.clear(warnkey)
+        alertstate.clear(fullkey)
+    return emailtype, statekey, percentage
 
-def cleanupfiles(checkfile, daysback):
-    delta = timedelta(days=daysback).total_seconds()
-    age = time() - int(delta)
-    try:
-        if age > os.path.getmtime(checkfile):
-            os.remove(checkfile)
-    except:
-        pass
+def check_projection(system, record, secondsleft, horizon, alertstate):
+    '''Alert when a quota below its warn threshold is forecast to fill within horizon seconds'''
+    statekey = (system, record.application, os.path.basename(record.key), 'projected')
+    alertstate.expire(statekey, 1)
+    if secondsleft is not None and secondsleft <= horizon:
+        return 'projected', statekey, secondsleft / 3600.0
+    alertstate.clear(statekey)
+    return '', statekey, None
 
 def read_template(filename, template_path):
     filepath = os.path.join(template_path, filename)
@@ -703,50 +1872,159 @@ def read_template(filename, template_path):
         template = template_file.read()
     return Template(template)
 
-def buildmail(maildict, template_path, default_subject):
+class alert_dispatcher:
+    '''Sends alert mail over a small pool of persistent SMTP connections'''
+    def __init__(self, email_settings):
+        self.email_settings = email_settings
+        self.connections = email_settings.get('smtp_connections', 2)
+        self.batch_size = email_settings.get('smtp_batch_size', 50)
+        self.retries = email_settings.get('smtp_retries', 2)
+        self.templates = {}
+        self.sent = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def get_template(self, filename):
+        if filename not in self.templates:
+            self.templates[filename] = read_template(filename, self.email_settings['template_path'])
+        return self.templates[filename]
+
+    def build_message(self, subject, body, recipients):
+        mmsg = MIMEText(body, 'html')
+        mmsg['Subject'] = subject
+        mmsg['From'] = self.email_settings['sender_address']
+        mmsg['To'] = ", ".join(recipients)
+        return mmsg
+
+    def send_batch(self, batch):
+        session = None
+        for subject, body, recipients in batch:
+            mmsg = self.build_message(subject, body, recipients)
+            for attempt in range(self.retries + 1):
+                try:
+                    if session is None:
+                        session = smtplib.SMTP(self.email_settings['smtp_server'], timeout=60)
+                    session.sendmail(self.email_settings['sender_address'], recipients, mmsg.as_string())
+                    with self.lock:
+                        self.sent += 1
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as excpt:
+                    # The server rejected this message; retrying will not help
+                    logging.warn(('Exception in sending mail to {}'.format(recipients)))
+                    logging.warn(excpt)
+                    with self.lock:
+                        self.failed += 1
+                    break
+                except OSError as excpt:
+                    # Covers dropped and refused connections; start a new one for the retry
+                    session = None
+                    if attempt == self.retries:
+                        logging.warn(('Exception in sending mail to {}'.format(recipients)))
+                        logging.warn(excpt)
+                        with self.lock:
+                            self.failed += 1
+                except Exception as excpt:
+                    logging.warn(('Exception in sending mail to {}'.format(recipients)))
+                    logging.warn(excpt)
+                    with self.lock:
+                        self.failed += 1
+                    break
+        if session is not None:
+            try:
+                session.quit()
+            except Exception:
+                pass
+
+    def send_all(self, messages):
+        '''Send a list of (subject, body, recipients)'''
+        start = time()
+        batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=self.connections) as pool:
+                list(pool.map(self.send_batch, batches))
+        logging.info('Sent {} of {} alerts ({} failed) in {:.1f}s'.format(self.sent, len(messages), self.failed, time() - start))
+
+def buildmail(maildict, dispatcher, default_subject):
     mailtype = maildict['mailtype']
-    special = maildict['special']
+    quotapolicy = maildict['policy']
     labname = maildict['quotaname'].split('-')[0].capitalize()
     logging.info(f'Notifying on {maildict["nfspath"]}')
 
-    template = '{}{}.txt'.format(special, mailtype)
-
-    if special not in ('', 'soft'): 
-        subject = configdict['application_shares'][special]['subject'][mailtype]
+    template = quotapolicy.templates[mailtype]
+    if mailtype in quotapolicy.subjects:
+        subject = quotapolicy.subjects[mailtype]
 
     else:
-       subject = default_subject[mailtype].format(labname, maildict['system'])
+       subject = default_subject.get(mailtype, '{} {} Quota Projected To Fill').format(labname, maildict['system'])
 
-    body = read_template(template, template_path).substitute(
+    body = dispatcher.get_template(template).substitute(
         LABNAME=labname,
         STORAGE=maildict['system'],
         NFSPATH=maildict['nfspath'],
         PERCENTAGE=maildict['percentage'], 
         USAGE=maildict['usage'], 
-        QUOTA=maildict['quota']
+        QUOTA=maildict['quota'],
+        HOURS=maildict.get('hours', '')
         )
     return subject, body
 
-def send_mail(email_settings, subject, body, recipients):
+def builddigests(maillist, dispatcher, default_subject):
+    '''Give each recipient one message holding every alert that lists them, made of
+    each alert's usual subject and body. Recipients whose alerts are the same
+    share a message, so the storage team gets one digest however many labs
+    alerted, and each lab gets one with only its own alerts.'''
+    alerts = [buildmail(maildict, dispatcher, default_subject) for maildict in maillist]
+    byaddress = collections.OrderedDict()
+    for index, maildict in enumerate(maillist):
+        for address in maildict['mailto']:
+            indexes = byaddress.setdefault(address, [])
+            if not indexes or indexes[-1] != index:
+                indexes.append(index)
+    digests = collections.OrderedDict()
+    for address, indexes in byaddress.items():
+        digests.setdefault(tuple(indexes), []).append(address)
+    messages = []
+    for indexes, recipients in digests.items():
+        if len(indexes) == 1:
+            subject, body = alerts[indexes[0]]
+        else:
+            subject = default_subject.get('digest', '{} Quota Alerts').format(len(indexes))
+            body = '<br><hr><br>'.join('<b>{}</b><br><br>{}'.format(*alerts[index]) for index in indexes)
+        messages.append((subject, body, recipients))
+    logging.info('Combined {} alerts into {} digests'.format(len(maillist), len(messages)))
+    return messages
+
+def sendalerts(email_settings, only=None):
+    '''Decide and send alerts, returning the number of messages sent, or None if
+    another run held the alert state and they were skipped'''
+    forecasts = None
+    forecast_settings = configdict.get('forecast_settings')
+    if forecast_settings is not None and 'history_path' in configdict:
+        forecasts = forecastall(history_store(configdict['history_path']), forecast_settings)
+    horizon = forecast_settings.get('horizon_hours', 24) * 3600 if forecast_settings else 0
+    statepath = email_settings.get('state_path', '/var/tmp/quotamonitor-alerts.db')
+    alertstate = alert_state(statepath)
     try:
-        mmsg = MIMEText(body, 'html')
-        mmsg['Subject'] = subject
-        mmsg['From'] = email_settings['sender_address']
-        mmsg['To'] = ", ".join(recipients)
-#        print(mmsg)
-        
-        session = smtplib.SMTP(email_settings['smtp_server'])
-        session.sendmail(email_settings['sender_address'], recipients, mmsg.as_string())
-        session.quit()
-    except Exception as excpt:
-        logging.warn(('Exception in sending mail to {}'.format(recipients)))
-        logging.warn(excpt)
-
-def sendalerts(email_settings, groupdict):
-    maillist = process_emails(email_settings['default_recipient'], email_settings['default_alert_percent'], groupdict)
-    for maildict in maillist:
-        subject, body = buildmail(maildict, email_settings['template_path'], email_settings['subject'])
-        send_mail(email_settings, subject, body, maildict['mailto'])
+        alertstate.open()
+    except sqlite3.OperationalError as excpt:
+        # Another run still has the state locked; it is sending these alerts
+        logging.error("Skipping alerts, could not lock {}: {}".format(statepath, excpt))
+        return None
+    try:
+        maillist = process_emails(alertpolicy, alertstate, only, forecasts, horizon)
+        alertstate.commit()
+    finally:
+        alertstate.close()
+    dispatcher = alert_dispatcher(email_settings)
+    if email_settings.get('digest', False):
+        messages = builddigests(maillist, dispatcher, email_settings['subject'])
+    else:
+        messages = []
+        for maildict in maillist:
+            subject, body = buildmail(maildict, dispatcher, email_settings['subject'])
+            messages.append((subject, body, maildict['mailto']))
+    dispatcher.send_all(messages)
+    return len(messages)
 
 #Database functions
 
@@ -755,53 +2033,116 @@ def getinfofromdb(qdb, command):
     result = qdb.fetchall()
     return result
 
-def createinsertion(loglist, dbmap):
+def dblabname(lab, special):
+    '''The Path a lab is stored under in the database'''
+    if special not in ('', 'soft'):
+        return '{}-{}'.format(lab, special)
+    return lab
+
+def dbdelta(dbmap, delta, inserted):
+    '''Return the (tier, Path) pairs the db stage still needs, or None when it needs
+    every quota. Every quota of a system is needed when it has not had all of its
+    quotas inserted today (inserted is {system: date}), so the first run of a
+    day, or the first good run after a failed one, covers the whole system.
+    Otherwise only quotas added since the last run are needed, since everything
+    else already has a row for today; quotas with the same Path on other systems
+    in the tier are still summed in, so the totals stay whole.'''
+    today = str(datetime.now().date())
+    if delta is None or all(inserted.get(system) != today for system in systemdict):
+        return None
+    newpaths = set()
+    for system, obj in systemdict.items():
+        if inserted.get(system) != today:
+            keys = obj.quotadict
+        else:
+            keys = delta.get(system, {}).get('added', ())
+        for key in keys:
+            record = obj.quotadict[key]
+            newpaths.add((dbmap.get(system), dblabname(record.lab, record.application)))
+    logging.info("{} quotas are new today".format(len(newpaths)))
+    return newpaths
+
+def markinserted(inserted):
+    '''Record today as the date of the last full insert of every system collected this run'''
+    today = str(datetime.now().date())
+    for system in systemdict:
+        result = collectionstats.get(system)
+        if result is None or result['status'] == 'ok':
+            inserted[system] = today
+
+def dbkey(name):
+    '''Fold a Name or Path the way the db's default collation compares them,
+    ignoring case and trailing spaces, so lookups in memory match what a
+    WHERE clause would have'''
+    return name.rstrip(' ').lower()
+
+def load_maps(qdb):
+    '''Return {dbkey(Name): Id} for the whole Maps table'''
+    return {dbkey(name):mapid for mapid, name in getinfofromdb(qdb, 'SELECT Id, Name FROM Maps')}
+
+def load_existing_paths(qdb, tier, date):
+    '''Return the set of dbkey(Path) for Paths that already have a row in tier for date'''
+    qdb.execute('SELECT Path FROM {} WHERE Date = %s'.format(tier), (date,))
+    return set(dbkey(row[0]) for row in qdb.fetchall())
+
+def createinsertion(dbmap, only=None):
+    '''Insert today's row for every quota in systemdict, or only for the (tier, Path)
+    pairs in only, summing quotas that share a Path within a tier'''
+    if not any(obj.quotadict for obj in systemdict.values()) or (only is not None and not only):
+        logging.info('Nothing new to insert into the db')
+        return 0
     dbcon, qdb = connect_to_db()
     holdingdict = {}
     #insertiondict = {}
     currdate = datetime.fromtimestamp(time())
-    for system in list(loglist.keys()):
+    maps = load_maps(qdb)
+    existing = {}
+    for system, obj in systemdict.items():
         tier = dbmap[system]
-        if tier not in list(holdingdict.keys()):
+        if tier not in holdingdict:
             holdingdict[tier] = {}
-        for lab in (lab for lab in loglist[system] if len(lab) != 0 and 'FREE' not in lab[0]):
-            if lab[4] not in ('', 'soft'):
-                labname = '{}-{}'.format(lab[0], lab[4])
-            else:
-                labname = lab[0]
-            used = lab[1]
-            quota = lab[2]
-
-            try:
-                mapid = getinfofromdb(qdb, 'SELECT Id FROM Maps WHERE Name="{}"'.format(lab[0]))[0][0]
-            except Exception as excpt:
-                logging.info(('mapping not found: {} {}'.format(labname, excpt)))
+            existing[tier] = load_existing_paths(qdb, tier, currdate.date())
+        for record in obj.quotadict.values():
+            labname = dblabname(record.lab, record.application)
+            if only is not None and (tier, labname) not in only:
                 continue
-            dbentry = getinfofromdb(qdb, 'SELECT * FROM {} where Path = "{}" AND Date = "{}"'.format(tier, labname, currdate.date()))
-            if len(list(dbentry)) == 0:
-                if labname not in list(holdingdict[tier].keys()):
-                    holdingdict[tier][labname] = {'date':currdate.date(), 'used':used, 'quota':quota, 'mapping':mapid}
-                else:
-                    totquot = holdingdict[tier][labname]['quota'] + quota
-                    totused = holdingdict[tier][labname]['used'] + used
-                    holdingdict[tier][labname]['quota'] = totquot
-                    holdingdict[tier][labname]['used'] = totused
-            else:
+            mapid = maps.get(dbkey(record.lab))
+            if mapid is None:
+                logging.info(('mapping not found: {}'.format(labname)))
+                continue
+            if dbkey(labname) in existing[tier]:
                 continue
-    insertintotable(holdingdict, qdb, dbcon)
+            holding = holdingdict[tier].get(labname)
+            if holding is None:
+                holdingdict[tier][labname] = {'date':currdate.date(), 'used':record.usage, 'quota':record.quota, 'files':record.files, 'mapping':mapid}
+            else:
+                holding['quota'] += record.quota
+                holding['used'] += record.usage
+                holding['files'] += record.files
+    return insertintotable(holdingdict, qdb, dbcon)
 
 def insertintotable(holdingdict, qdb, dbcon):
+    # File counts only go in if the tables have a column for them
+    filescolumn = configdict['db_settings'].get('files_column')
+    inserted = 0
     for tier in (tier for tier in list(holdingdict.keys()) if holdingdict[tier]):
         insertionlist = []
         for lab, insdict in holdingdict[tier].items():
-            insertionlist.append((insdict['date'], lab, insdict['used'], insdict['quota'], insdict['mapping']))
-        sql = "INSERT INTO {} (Date, Path, Used, Hard, Map) VALUES (%s, %s, %s, %s, %s)".format(tier)
+            row = (insdict['date'], lab, insdict['used'], insdict['quota'], insdict['mapping'])
+            insertionlist.append(row + (insdict['files'],) if filescolumn else row)
+        if filescolumn:
+            sql = "INSERT INTO {} (Date, Path, Used, Hard, Map, {}) VALUES (%s, %s, %s, %s, %s, %s)".format(tier, filescolumn)
+        else:
+            sql = "INSERT INTO {} (Date, Path, Used, Hard, Map) VALUES (%s, %s, %s, %s, %s)".format(tier)
         qdb.executemany(sql, insertionlist)
+        inserted += len(insertionlist)
     dbcon.commit()
     qdb.close()
     dbcon.close()
+    return inserted
 
 def connect_to_db():
+    import pymysql as mdb
     try:
         dbcon = mdb.connect(
                         host=configdict['db_settings']['host'],
@@ -814,8 +2155,169 @@ def connect_to_db():
         sys.exit(1)
     return dbcon, dbcon.cursor()
 
+### Daemon ###
+
+class quota_daemon:
+    '''Long running alternative to a single pass from cron, polling each system on its own schedule'''
+    def __init__(self, custom_mapping, groupdict):
+        self.custom_mapping = custom_mapping
+        self.groupdict = groupdict
+        self.settings = configdict.get('daemon_settings', {})
+        self.timeout = configdict.get('collection_settings', {}).get('timeout', 900)
+        self.backends = {}
+        for systemname, config in configdict['storagesystems'].items():
+            if systemname == 'starfish':
+                backend = sf_api(config)
+            else:
+                backend = createbackend(systemname, config)
+            if backend is not None:
+                self.backends[systemname] = backend
+        logstartup(list(self.backends.keys()))
+        self.history = history_store(configdict['history_path']) if 'history_path' in configdict else None
+        self.metrics = configdict.get('metrics_settings', {})
+        self.lastsuccess = {}
+        self.latest = {}
+        self.softquotadict = {}
+        self.polling = set()
+        self.lock = threading.Lock()
+        self.scheduler = sched.scheduler(time, sleep)
+
+    def collect(self, systemname):
+        backend = self.backends[systemname]
+        if systemname == 'starfish':
+            work = lambda: get_soft_quotas(backend, self.custom_mapping, self.groupdict)
+        else:
+            work = lambda: backend.process_quotas(self.custom_mapping, self.groupdict)
+        state = {'finished':False, 'abandoned':False}
+
+        def task():
+            try:
+                work()
+            finally:
+                with self.lock:
+                    state['finished'] = True
+                    if state['abandoned']:
+                        # The backend is free again, so the system can be polled
+                        self.polling.discard(systemname)
+                        logging.info("Abandoned poll of {} has returned".format(systemname))
+        timeout = configdict['storagesystems'][systemname].get('timeout', self.timeout)
+        result = run_with_deadlines({systemname:(task, timeout)}, 1)[systemname]
+        with self.lock:
+            collectionstats[systemname] = result
+            if logcollection(systemname, result):
+                self.lastsuccess[systemname] = time()
+                if systemname == 'starfish':
+                    self.softquotadict = backend.softquotadict
+                    self.install(list(self.softquotadict.keys()))
+                    if self.history is not None:
+                        for volume, entry in self.softquotadict.items():
+                            appendhistory(self.history, softhistoryname(volume), time(), entry)
+                else:
+                    self.latest[systemname] = (backend.quotadict, backend.freespace)
+                    self.install([systemname])
+                    if self.history is not None:
+                        appendhistory(self.history, systemname, time(), backend.quotadict, backend.freespace)
+            elif hasattr(backend, 'loggedin'):
+                # The session may have expired, so log in again on the next poll
+                backend.loggedin = False
+            if state['finished']:
+                self.polling.discard(systemname)
+            else:
+                # The abandoned thread is still filling in the backend; polling again
+                # now would have two threads building the same quotadict
+                state['abandoned'] = True
+            if 'textfile' in self.metrics:
+                writemetrics(self.metrics['textfile'], self.lastsuccess)
+
+    def install(self, systemnames):
+        '''Publish the latest results for systemnames, merged with their soft quotas.
+        systemdict is replaced rather than changed in place, so a stage that is
+        already running keeps a consistent view.'''
+        global systemdict
+        snapshot = dict(systemdict)
+        for systemname in systemnames:
+            if systemname in self.latest:
+                entry = copy.copy(self.backends[systemname])
+                quotadict, entry.freespace = self.latest[systemname]
+                entry.quotadict = dict(quotadict)
+            else:
+                entry = unlisted_storage(systemname)
+            entry.quotadict.update(self.softquotadict.get(systemname, {}))
+            snapshot[systemname] = entry
+        systemdict = snapshot
+
+    def poll(self, systemname):
+        interval = configdict['storagesystems'][systemname].get('poll_interval', self.settings.get('poll_interval', 900))
+        self.scheduler.enter(interval, 1, self.poll, (systemname,))
+        with self.lock:
+            if systemname in self.polling:
+                logging.warning("Skipping poll of {}, the last one is still running".format(systemname))
+                return
+            self.polling.add(systemname)
+        threading.Thread(target=self.collect, args=(systemname,), name='poll-{}'.format(systemname), daemon=True).start()
+
+    def stage(self, name, func, interval):
+        self.scheduler.enter(interval, 2, self.stage, (name, func, interval))
+        logging.info('Running {} stage'.format(name))
+        try:
+            func()
+        except (Exception, SystemExit) as ex:
+            logging.error("{} stage failed: {}".format(name, ex))
+
+    def run(self):
+        global systemdict
+        global collectionstats
+        systemdict = {}
+        collectionstats = {}
+        if 'port' in self.metrics:
+            servemetrics(self.metrics['port'], self.lastsuccess)
+        for systemname in self.backends:
+            self.poll(systemname)
+        stages = (
+            ('csv', lambda: writecsvs(), self.settings.get('csv_interval', 900)),
+            ('alert', lambda: sendalerts(configdict['email_settings']), self.settings.get('alert_interval', 3600)),
+            ('db', lambda: createinsertion(configdict['db_settings']['map']), self.settings.get('db_interval', 86400)),
+            )
+        for name, func, interval in stages:
+            # An interval of 0 turns a stage off
+            if interval:
+                self.scheduler.enter(interval, 2, self.stage, (name, func, interval))
+        self.scheduler.run()
+
 ### Main ###
 
+def runonce(args, groupdict, custom_mapping):
+    global systemdict
+    with runreport.phase('collect') as phase:
+        systemdict = buildsystemdict(custom_mapping, groupdict)
+        phase['items'] = sum(len(obj.quotadict) for obj in systemdict.values())
+    with runreport.phase('snapshot') as phase:
+        snapshotpath = configdict.get('snapshot_path', '/var/tmp/quotamonitor-snapshot.json.gz')
+        previous = load_snapshot(snapshotpath)
+        snapshot = buildsnapshot(previous)
+        delta = None if args.full else diffsnapshot(previous, snapshot)
+        phase['items'] = len(changedsystems(delta) or snapshot['systems'])
+    if 'history_path' in configdict:
+        with runreport.phase('history'):
+            recordhistory(history_store(configdict['history_path']))
+    metrics_settings = configdict.get('metrics_settings', {})
+    if 'textfile' in metrics_settings:
+        with runreport.phase('metrics'):
+            writemetrics(metrics_settings['textfile'], snapshot['collected'])
+    with runreport.phase('csv') as phase:
+        phase['items'] = writecsvs(changedsystems(delta))
+    with runreport.phase('alerts') as phase:
+        # If the last run had to skip its alerts, the quotas it saw change were never
+        # checked, so check everything
+        only = None if previous.get('alerts_pending') else changedquotas(delta)
+        phase['items'] = sendalerts(configdict['email_settings'], only)
+        snapshot['alerts_pending'] = phase['items'] is None
+    with runreport.phase('db') as phase:
+        dbmap = configdict['db_settings']['map']
+        phase['items'] = createinsertion(dbmap, dbdelta(dbmap, delta, snapshot['inserted']))
+        markinserted(snapshot['inserted'])
+    save_snapshot(snapshotpath, snapshot)
+
 if __name__ == '__main__':
     argv = sys.argv[1:]
 
@@ -826,6 +2328,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser('Check quota status, create log file, and email if over quota')
     parser.add_argument('-c', '--config', type=str, default=configpath, required=False, help='Path to config file, defaults to ./uconfig.json')
     parser.add_argument('-l', '--loglevel', type=str, default='warn', help='Level of logging: debug, info, error, warn, default to warn')
+    parser.add_argument('-d', '--daemon', action='store_true', help='Keep running and poll each system on its own schedule')
+    parser.add_argument('--full', action='store_true', help='Process every quota, not only those that changed since the last run')
+    parser.add_argument('--report', type=str, default=None, help='Write a json report of where the time of the run went to this path')
+    parser.add_argument('--profile', type=str, default=None, help='Run under cProfile and write the stats to this path')
     parser.add_argument('--logpath', type=str, default='/var/log/uquota.log', help='path to syslog file, default: /var/log/uquotas.log')
     args = parser.parse_args()
     configpath = args.config
@@ -846,16 +2352,28 @@ if __name__ == '__main__':
 
     global configdict
     global systemdict
+    global pathindex
+    global alertpolicy
     logging.info('Starting quota gather')
     #now = datetime.now()
     #print (now.strftime("%Y-%m-%d %H:%M:%S"))
-    configdict, groupdict, custom_mapping = getconfig(configpath)
-    systemdict = buildsystemdict(custom_mapping, groupdict)
-    loglist = buildloglist()
-    logging.info('Writing csvs')
-    writecsvs(loglist)
-    logging.info('Sending alerts')
-    sendalerts(configdict['email_settings'], groupdict)
-    logging.info('Inserting into db')
-    createinsertion(loglist, configdict['db_settings']['map'])
+    configdict, groupdict, alertpolicy = getconfig(configpath)
+    custom_mapping = alertpolicy.custom_mapping
+    httppool.configure(configdict.get('http_settings', {}))
+    pathindex = path_index(configdict, groupdict, custom_mapping)
+    if args.daemon:
+        logging.info('Starting quota daemon')
+        quota_daemon(custom_mapping, groupdict).run()
+        sys.exit(0)
+    if args.report:
+        runreport.instrument_paths(pathindex)
+    if args.profile:
+        runreport.profiling = True
+        mainprofile = cProfile.Profile()
+        mainprofile.runcall(runonce, args, groupdict, custom_mapping)
+        runreport.write_profile(args.profile, mainprofile)
+    else:
+        runonce(args, groupdict, custom_mapping)
+    if args.report:
+        runreport.write(args.report)
     logging.info('Done')